@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for 'Python pairwise comparison letter generator'
+
+Generates synthetic comparison sets offline and times stack_correlation_table, scikit_results_munger, post_hoc_df
+and each stage of multi_comparisons_letter_df_generator separately, with the peak memory of each, as well as the
+cold import of each module. Results are
+written as JSON (with the git commit) so runs on different commits can be compared:
+
+    python benchmark_letters.py --output before.json
+    python benchmark_letters.py --output after.json --compare before.json
+
+Github: PhilPlantMan
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import pairwisecomp_core as core
+from pairwisecomp_letters import multi_comparisons_letter_df_generator, comparison_indices, \
+    stack_correlation_table, scikit_results_munger, post_hoc_df
+
+PATTERNS = ["chain", "block", "random", "scattered"]
+MODULES = ["pairwisecomp_core", "pairwisecomp_letters", "custom_boxplot_functions"]
+_IMPORT_SCRIPT = """
+import sys, time, tracemalloc
+if sys.argv[2] == 'memory': tracemalloc.start()
+start = time.perf_counter()
+__import__(sys.argv[1])
+print(time.perf_counter() - start, tracemalloc.get_traced_memory()[1])
+"""
+
+def synthetic_means(n_groups, density, pattern, rng):
+    """
+    Returns group means and the difference above which two groups are significantly different, so that about
+    density of all pairs are rejected:
+    + "chain" evenly spaced means, giving a chain of overlapping letters
+    + "block" clusters of equal means, rejected between clusters and not within
+    + "random" uniformly drawn means, as from a real experiment
+    """
+    if pattern == "chain": means = np.arange(n_groups, dtype = float)
+    elif pattern == "block":
+        n_blocks = int(np.clip(round(1 / max(1 - density, 1e-9)), 1, n_groups))
+        return np.sort(rng.integers(0, n_blocks, n_groups)).astype(float), 0.5
+    elif pattern == "random": means = np.sort(rng.uniform(0, n_groups, n_groups))
+    else: raise ValueError("pattern must be one of {}".format(PATTERNS))
+    A, B = np.triu_indices(n_groups, 1)
+    return means, np.quantile(np.abs(means[A] - means[B]), 1 - density) if n_groups > 1 else 0.0
+
+def synthetic_comparisons(n_groups, density, pattern, seed = 0):
+    """
+    Returns (p_table, comparisons_df, means): a square df of p values between the groups 'g000', 'g001'... (0.001
+    for rejected pairs, 0.5 otherwise), its comparisons as returned by scikit_results_munger at alpha 0.05, and
+    the group means (None for "scattered").
+
+    "scattered" rejects each pair independently with probability density. Real post hoc results are never like
+    this and the number of letters can grow exponentially with the number of groups, so it is a stress test only.
+    """
+    rng = np.random.default_rng(seed)
+    A, B = np.triu_indices(n_groups, 1)
+    if pattern == "scattered": means, reject = None, rng.random(A.size) < density
+    else:
+        means, threshold = synthetic_means(n_groups, density, pattern, rng)
+        reject = np.abs(means[A] - means[B]) > threshold
+    labels = ['g{:03d}'.format(group) for group in range(n_groups)]
+    p = np.full((n_groups, n_groups), 1.0)
+    p[A, B] = p[B, A] = np.where(reject, 0.001, 0.5)
+    p_table = pd.DataFrame(p, index = labels, columns = labels)
+    return p_table, scikit_results_munger(p_table, 0.05), means
+
+def synthetic_observations(means, n_observations, seed = 0):
+    """
+    Returns a df of n_observations normally distributed values ('Y') for each group ('group') around 4 x its mean
+    """
+    rng = np.random.default_rng(seed)
+    group = np.repeat(np.arange(len(means)), n_observations)
+    return pd.DataFrame({'Y': rng.normal(4 * np.asarray(means)[group], 1.0),
+                         'group': np.array(['g{:03d}'.format(g) for g in range(len(means))])[group]})
+
+def measure(function, repeats = 3):
+    """
+    Returns (result, timings) for function: the best and median wall time of repeats calls and the peak traced
+    memory of one further call (traced separately as tracemalloc slows the call down)
+    """
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {'Seconds': min(seconds), 'Median seconds': float(np.median(seconds)), 'Peak bytes': peak}
+
+def lettering_stages(comparisons_df, cycles, seed, repeats, clique_max_groups):
+    """
+    Yields (stage, timings) for each stage of multi_comparisons_letter_df_generator, timed separately, and for the
+    whole call
+    """
+    (index, group1, group2, reject), timings = measure(lambda: comparison_indices(comparisons_df), repeats)
+    yield 'comparison_indices', timings
+    n_groups = len(index)
+    inserted, timings = measure(lambda: core.insert_stage(n_groups, group1, group2, reject), repeats)
+    yield 'insert stage', timings
+    letters, timings = measure(lambda: core.absorb_stage(inserted), repeats)
+    yield 'absorb stage', timings
+    (required, valid), timings = measure(lambda: (core.required_pairs(n_groups, group1, group2, reject),
+                                                  core.letters_valid(letters, group1, group2, reject)), repeats)
+    yield 'validity check', timings
+    (best, _), timings = measure(lambda: core.run_sweep_cycles(letters, required, valid, "Number of different letters",
+                                                               cycles, random_state = seed), repeats)
+    yield 'sweep cycles', timings
+    ordering = pd.Series(np.arange(n_groups, dtype = float), index = index)
+    _, timings = measure(lambda: core.letter_strings(best[:, core.letter_column_order(best, ordering)]), repeats)
+    yield 'order and strings', timings
+    _, timings = measure(lambda: multi_comparisons_letter_df_generator(comparisons_df, letter_ordering_series = ordering,
+                                                                       monte_carlo_cycles = cycles, random_state = seed),
+                         repeats)
+    timings['Letters'] = best.shape[1]
+    yield 'multi_comparisons_letter_df_generator', timings
+    if n_groups <= clique_max_groups:
+        (_, report), timings = measure(lambda: core.clique_cover(n_groups, group1, group2, reject), repeats)
+        timings['Letters'] = report['Number of different letters']
+        yield 'clique cover', timings
+
+def run_benchmarks(groups, densities, patterns, repeats = 3, cycles = 5, observations = 20, seed = 0,
+                   clique_max_groups = 40, progress = None):
+    """
+    Returns a list of result dicts (pattern, groups, density, stage and the timings of measure) for every
+    combination of groups, densities and patterns
+    """
+    results = []
+    for pattern in patterns:
+        for n_groups in groups:
+            for density in densities:
+                case = {'Pattern': pattern, 'Groups': n_groups, 'Density': density}
+                p_table, comparisons_df, means = synthetic_comparisons(n_groups, density, pattern, seed)
+                stages = [('stack_correlation_table', lambda: stack_correlation_table(p_table)),
+                          ('scikit_results_munger', lambda: scikit_results_munger(p_table, 0.05))]
+                if means is not None and observations:
+                    df = synthetic_observations(means, observations, seed)
+                    stages += [('post_hoc_df tukey', lambda: post_hoc_df(df, 'Y', 'group', posthoc = 'tukey')),
+                               ('post_hoc_df dunn', lambda: post_hoc_df(df, 'Y', 'group', posthoc = 'dunn'))]
+                timed = [(stage, measure(function, repeats)[1]) for stage, function in stages]
+                timed += list(lettering_stages(comparisons_df, cycles, seed, repeats, clique_max_groups))
+                for stage, timings in timed:
+                    results.append(dict(case, Stage = stage, **timings))
+                    if progress is not None: progress(results[-1])
+    return results
+
+def import_times(modules = MODULES, repeats = 3):
+    """
+    Returns a list of result dicts (stage 'import <module>') with the best and median time to import each module in
+    a fresh interpreter, and the peak traced memory of one further import
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    def run(module, mode):
+        output = subprocess.run([sys.executable, '-c', _IMPORT_SCRIPT, module, mode], cwd = directory,
+                                capture_output = True, text = True, check = True).stdout.split()
+        return float(output[0]), int(output[1])
+    results = []
+    for module in modules:
+        seconds = [run(module, 'time')[0] for _ in range(repeats)]
+        results.append({'Pattern': 'import', 'Groups': 0, 'Density': 0.0, 'Stage': 'import ' + module,
+                        'Seconds': min(seconds), 'Median seconds': float(np.median(seconds)),
+                        'Peak bytes': run(module, 'memory')[1]})
+    return results
+
+def git_commit():
+    """
+    Returns the commit of the working tree, suffixed with '-dirty' when it has changes, or None outside git
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = directory, capture_output = True,
+                                text = True, check = True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd = directory,
+                               capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError): return None
+    return commit + '-dirty' if dirty else commit
+
+def compare(results, baseline, threshold = 1.25, min_seconds = 0.001):
+    """
+    Returns a df joining results to the results of a baseline run on (pattern, groups, density, stage) with the
+    ratio of the best times; 'Regression' marks ratios above threshold where the stage also got at least
+    min_seconds slower (shorter stages are mostly timer noise)
+    """
+    keys = ['Pattern', 'Groups', 'Density', 'Stage']
+    table = pd.DataFrame(results)[keys + ['Seconds', 'Peak bytes']].merge(
+        pd.DataFrame(baseline)[keys + ['Seconds', 'Peak bytes']], on = keys, suffixes = ('', ' baseline'))
+    table['Ratio'] = table['Seconds'] / table['Seconds baseline']
+    table['Regression'] = (table['Ratio'] > threshold) & (table['Seconds'] - table['Seconds baseline'] >= min_seconds)
+    return table
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the pairwise comparison letter pipeline on synthetic data")
+    parser.add_argument('--groups', type = int, nargs = '+', default = [5, 10, 20, 50, 100, 200])
+    parser.add_argument('--densities', type = float, nargs = '+', default = [0.2, 0.5, 0.8],
+                        help = "fractions of significantly different pairs")
+    parser.add_argument('--patterns', nargs = '+', default = ["chain", "block", "random"], choices = PATTERNS)
+    parser.add_argument('--repeats', type = int, default = 3)
+    parser.add_argument('--cycles', type = int, default = 5, help = "monte_carlo_cycles")
+    parser.add_argument('--observations', type = int, default = 20,
+                        help = "observations per group for post_hoc_df (0 to skip)")
+    parser.add_argument('--clique-max-groups', type = int, default = 40,
+                        help = "largest number of groups to time the clique engine on")
+    parser.add_argument('--import-repeats', type = int, default = 3,
+                        help = "cold imports timed per module (0 to skip)")
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', default = 'benchmark_results.json')
+    parser.add_argument('--compare', metavar = 'BASELINE', help = "results JSON of an earlier run to compare with")
+    parser.add_argument('--threshold', type = float, default = 1.25,
+                        help = "time ratio above which a stage counts as a regression")
+    parser.add_argument('--min-seconds', type = float, default = 0.001,
+                        help = "smallest slowdown in seconds that counts as a regression")
+    args = parser.parse_args(argv)
+
+    def progress(result):
+        print("{Pattern:>9} {Groups:>4} {Density:>5} {Stage:<40} {Seconds:10.5f} s {Peak bytes:>12,} B".format(**result),
+              flush = True)
+    results = import_times(repeats = args.import_repeats) if args.import_repeats else []
+    for result in results: progress(result)
+    results += run_benchmarks(args.groups, args.densities, args.patterns, repeats = args.repeats, cycles = args.cycles,
+                             observations = args.observations, seed = args.seed,
+                             clique_max_groups = args.clique_max_groups, progress = progress)
+    run = {'Commit': git_commit(), 'Date': datetime.now(timezone.utc).isoformat(), 'Python': platform.python_version(),
+           'NumPy': np.__version__, 'pandas': pd.__version__, 'Platform': platform.platform(),
+           'Arguments': vars(args), 'Results': results}
+    with open(args.output, 'w') as file: json.dump(run, file, indent = 1)
+    print("Results written to {}".format(args.output))
+    if args.compare:
+        with open(args.compare) as file: baseline = json.load(file)
+        table = compare(results, baseline['Results'], args.threshold, args.min_seconds)
+        print("Compared with {} ({})".format(args.compare, baseline.get('Commit')))
+        print(table.to_string(index = False))
+        if table['Regression'].any():
+            print("{} stage(s) more than {}x slower".format(table['Regression'].sum(), args.threshold))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
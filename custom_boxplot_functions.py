@@ -5,39 +5,119 @@ Boxplot extenstion for 'Python pairwise comparison letter generator'
 
 Github: PhilPlantMan
 """
+import os
+import time
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from matplotlib.ticker import AutoMinorLocator
-from pairwisecomp_letters import multi_comparisons_letter_df_generator, post_hoc_df
+from concurrent.futures import ProcessPoolExecutor
+import pairwisecomp_core as core
+from pairwisecomp_letters import posthoc_letters, factorise_groups
+# matplotlib and seaborn are imported by the functions that draw, the first time they are called, so importing this 
+# module (e.g. in render_boxplots workers before the first job) stays cheap
+
+BOXPLOT_RC = {'figure.constrained_layout.use': True,
+              'font.size': 12,          # controls default text sizes
+              'axes.titlesize': 12,     # fontsize of the axes title
+              'axes.labelsize': 12,     # fontsize of the x and y labels
+              'xtick.labelsize': 12,    # fontsize of the tick labels
+              'ytick.labelsize': 12,    # fontsize of the tick labels
+              'legend.fontsize': 12}    # legend fontsize
+
+def _figure_width(df, X_col, hue_col):
+    groups = df[X_col].nunique()
+    boxs_per_group = 1 if hue_col is None else df[hue_col].nunique()
+    return 1.5+ (.4*boxs_per_group * groups) + (.1 * groups)
+
+def _set_ticks(axis, tick_kwargs):
+    """
+    Object-oriented plt.xticks/plt.yticks: optional 'ticks' and 'labels' plus Text properties for the tick labels
+    """
+    tick_kwargs = dict(tick_kwargs)
+    ticks, labels = tick_kwargs.pop('ticks', None), tick_kwargs.pop('labels', None)
+    if ticks is not None: axis.set_ticks(ticks, labels)
+    elif labels is not None: axis.set_ticklabels(labels)
+    for label in axis.get_ticklabels(): label.set(**tick_kwargs)
+
+def _plotted_rows(df, X_col, hue_col, X_order, hue_order):
+    df = df[df[X_col].isin(X_order)]
+    if hue_col != None: df = df[df[hue_col].isin(hue_order)]
+    return df
+
+def subsample_boxes(df, grouping_cols, max_points_per_box, random_state = None):
+    """
+    Returns at most max_points_per_box random rows of df for each box (combination of grouping_cols), reproducible 
+    for a given random_state. Boxes with fewer rows keep all of them.
+    """
+    rng = np.random.default_rng(random_state)
+    shuffled = df.iloc[rng.permutation(len(df))]
+    keep = shuffled.groupby(grouping_cols, sort = False).cumcount().to_numpy() < max_points_per_box
+    return shuffled[keep]
+
+def histogram_strip(ax, df, Y_col, X_col, box_stats, hue_col = None, bins = 50, width = .4, **kwargs):
+    """
+    Draws each box's distribution of Y_col as a horizontal histogram centred on the box (a mirrored bar per bin whose 
+    width follows the bin count relative to the box's fullest bin, up to width) as one PolyCollection, and returns 
+    it. The bins are shared by all boxes and counted for all rows at once, so the cost does not grow with the number 
+    of points drawn. kwargs go to PolyCollection.
+    """
+    from matplotlib.collections import PolyCollection
+    grouping_cols = [X_col]
+    if hue_col is not None: grouping_cols.append(hue_col)
+    values = df[Y_col].to_numpy(dtype = float)
+    codes, keys = factorise_groups(df, grouping_cols)
+    box = np.append(box_stats.index.get_indexer(keys), -1)[codes]
+    rows = (box >= 0) & np.isfinite(values)
+    edges = np.histogram_bin_edges(values[rows], bins = bins)
+    counts = np.zeros((len(box_stats), len(edges) - 1))
+    np.add.at(counts, (box[rows], np.clip(np.searchsorted(edges, values[rows], side = 'right') - 1, 0, len(edges) - 2)), 1)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        half_widths = np.nan_to_num(counts / counts.max(axis = 1, keepdims = True)) * width / 2
+    box_index, bin_index = np.nonzero(counts)
+    x = box_stats['x'].to_numpy()[box_index][:, None]
+    w = half_widths[box_index, bin_index][:, None]
+    low, high = edges[bin_index][:, None], edges[bin_index + 1][:, None]
+    verts = np.stack([np.hstack([x - w, x + w, x + w, x - w]), np.hstack([low, low, high, high])], axis = -1)
+    properties = dict(facecolors = 'white', edgecolors = 'black', linewidths = .5, alpha = 0.7, zorder = 3)
+    properties.update(kwargs)
+    collection = PolyCollection(verts, **properties)
+    ax.add_collection(collection)
+    return collection
 
 def grouped_boxplot_with_overlay(df, Y_col, X_col, hue_col, X_order, hue_order, 
-                                 hue_palette = "YlGn", xtick_kwargs = {}, ytick_kwargs = {}):
+                                 hue_palette = "YlGn", xtick_kwargs = {}, ytick_kwargs = {}, ax = None, box_stats = None, 
+                                 overlay = "points", max_points_per_box = None, random_state = None, 
+                                 rasterize_overlay = False, histogram_bins = 50):
     """
     Returns custom Seaborn grouped boxplot objects as a tuple (fig, ax, df)
+    
+    ax (default = None): Axes to draw on. By default all pyplot figures are closed, BOXPLOT_RC is applied to the global 
+    rc settings and a new pyplot figure is made. With an ax nothing global is touched; the caller is responsible for 
+    the styling (e.g. matplotlib.rc_context(BOXPLOT_RC)) and the figure size.
+    
+    box_stats (default = None): The box_stats_table of the plotted rows, whose largest max sets the top of the y axis. 
+    Computed here if not given.
+    
+    The boxes are always drawn from every row; overlay sets what is drawn over them:
+    + "points" (default) a stripplot of the observations, of at most max_points_per_box (default = None, no cap) per 
+    box sampled with subsample_boxes(random_state = random_state). rasterize_overlay = True rasterises the points 
+    so vector files stay small.
+    + "histogram" a histogram_strip with histogram_bins bins per box, for very large groups
+    + None nothing
     """
+    import seaborn as sns
+    from matplotlib.ticker import AutoMinorLocator
     # reduce df
-    plt.close('all')
-    df = df[df[X_col].isin(X_order)]
-    Ymax = df[Y_col].max()
-    groups = df[X_col].nunique()
-    boxs_per_group = 1
-    if hue_col != None:
-          df = df[df[hue_col].isin(hue_order)]
-          boxs_per_group = df[hue_col].nunique()
-    # parameters for layout       
-    boxs =  boxs_per_group * groups
-    fig_width = 1.5+ (.4*boxs) + (.1 * groups)
-    # plt settings
-    plt.rcParams['figure.constrained_layout.use'] = True
-    plt.rc('font', size=12)          # controls default text sizes
-    plt.rc('axes', titlesize=12)     # fontsize of the axes title
-    plt.rc('axes', labelsize=12)     # fontsize of the x and y labels
-    plt.rc('xtick', labelsize=12)    # fontsize of the tick labels
-    plt.rc('ytick', labelsize=12)    # fontsize of the tick labels
-    plt.rc('legend', fontsize=12)    # legend fontsize
-    # make figure and ax objects
-    fig, ax = plt.subplots(1, 1, figsize=(fig_width,5))
+    df = _plotted_rows(df, X_col, hue_col, X_order, hue_order)
+    if box_stats is None: box_stats = box_stats_table(df, Y_col, X_col, X_order, hue_col = hue_col, hue_order = hue_order)
+    Ymax = box_stats['max'].max()
+    if ax is None:
+        import matplotlib.pyplot as plt
+        plt.close('all')
+        # plt settings
+        plt.rcParams.update(BOXPLOT_RC)
+        # make figure and ax objects
+        fig, ax = plt.subplots(1, 1, figsize=(_figure_width(df, X_col, hue_col),5))
+    fig = ax.figure
     # make grouped boxplot 
     ax = sns.boxplot(y=Y_col, x=X_col, 
                      data=df, 
@@ -47,23 +127,36 @@ def grouped_boxplot_with_overlay(df, Y_col, X_col, hue_col, X_order, hue_order,
                      order = X_order,
                      fliersize = 0,
                      linewidth = 1.75,
-                     hue_order = hue_order)
+                     hue_order = hue_order,
+                     ax = ax)
     white_palette = sns.color_palette(['white'])
     # make grouped stripplot 
-    ax = sns.stripplot(y=Y_col, x=X_col, 
-                       data=df, 
-                       jitter=True,
-                       dodge=True, 
-                       marker='o', 
-                       alpha=0.9,
-                       hue=hue_col,
-                       color='white',
-                       palette = white_palette,
-                       size = 4,
-                       order = X_order,
-                       hue_order = hue_order,
-                       linewidth=1,
-                       edgecolor='black')
+    if overlay == "points":
+        points = df
+        if max_points_per_box is not None: 
+            points = subsample_boxes(df, [X_col] if hue_col is None else [X_col, hue_col], max_points_per_box, random_state)
+        n_collections = len(ax.collections)
+        ax = sns.stripplot(y=Y_col, x=X_col, 
+                           data=points, 
+                           jitter=True,
+                           dodge=True, 
+                           marker='o', 
+                           alpha=0.9,
+                           hue=hue_col,
+                           color='white',
+                           palette = white_palette,
+                           size = 4,
+                           order = X_order,
+                           hue_order = hue_order,
+                           linewidth=1,
+                           edgecolor='black',
+                           ax = ax)
+        if rasterize_overlay: 
+            for collection in ax.collections[n_collections:]: collection.set_rasterized(True)
+    elif overlay == "histogram":
+        histogram_strip(ax, df, Y_col, X_col, box_stats, hue_col = hue_col, bins = histogram_bins, 
+                        width = .4 / (1 if hue_col is None else len(hue_order)))
+    elif overlay is not None: raise ValueError("overlay must be 'points', 'histogram' or None")
     # appearance of axes
     ax.spines['right'].set_visible(False)
     ax.spines['top'].set_visible(False)
@@ -74,95 +167,155 @@ def grouped_boxplot_with_overlay(df, Y_col, X_col, hue_col, X_order, hue_order,
     ax.tick_params(which='major', length=7)
     ax.tick_params(which='minor', length=4)
     ax.axes.set_ylim(bottom=None, top= Ymax + (Ymax/10))
-    plt.xlabel("")
-    plt.xticks(**xtick_kwargs)
-    plt.yticks(**ytick_kwargs)
+    ax.set_xlabel("")
+    _set_ticks(ax.xaxis, xtick_kwargs)
+    _set_ticks(ax.yaxis, ytick_kwargs)
     # get legend information from the plot object and plot
     if hue_col != None:
         handles, labels = ax.axes.get_legend_handles_labels()
-        plt.legend(handles[0:int(len(handles)/2)], labels[0:int(len(handles)/2)],bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
+        if overlay == "points": handles, labels = handles[0:int(len(handles)/2)], labels[0:int(len(handles)/2)]
+        ax.legend(handles, labels,bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
 
     return (fig, ax, df)
 
-def annotate_above_box(df, ax, X_col, Y_col, X_order, text_series, hue_col = None, 
-                       hue_order = None,  annotation_kwargs = {}, **kwargs):
+def box_stats_table(df, Y_col, X_col, X_order, hue_col = None, hue_order = None):
     """
-    This function draws strings from a pandas series (text_series) at the X centre and Y max
-    for each box ontop of the mathplotlib.axes object.
+    Returns a df with one row per box in plotting order (indexed by X group, or by (X group, hue)) with the columns 
+    'count', 'median', 'max' and 'x' (the centre of the box on the X axis), from a single groupby over df.
     
     Each 'bar' is 0.8 wide by default in Seaborn. This width is shared by each box 
     within each bar (i.e. the number 'hues')
     """
-    number_of_hues = len(hue_order)
-    if hue_col == None: number_of_hues = 1
+    grouping_cols = [X_col]
+    if hue_col is not None: grouping_cols.append(hue_col)
+    stats = df.groupby(grouping_cols)[Y_col].agg(['count', 'median', 'max'])
+    if hue_col is None: boxes, number_of_hues = pd.Index(X_order, name = X_col), 1
+    else: boxes, number_of_hues = pd.MultiIndex.from_product([X_order, hue_order], names = grouping_cols), len(hue_order)
+    stats = stats.reindex(boxes)
+    stats['count'] = stats['count'].fillna(0).astype(int)
     box_interval = .8 / number_of_hues
-    box_centre_X_list = []
-    for group in range(len(X_order)):
-        position = group -.4 + (.5* box_interval)
-        box_centre_X_list.append(position)
-        for box in range(1 , number_of_hues):
-            position += box_interval
-            box_centre_X_list.append(position) # list X positions of each box for annotation
-    # calculate maximum values for each box
-    if hue_col is not None: box_maxs_series = df.groupby([X_col,hue_col])[Y_col].max()
-    else: box_maxs_series = df.groupby([X_col])[Y_col].max()
+    box = np.arange(len(boxes))
+    stats['x'] = box // number_of_hues - .4 + (.5 + box % number_of_hues) * box_interval
+    return stats
+
+def annotate_above_box(df, ax, X_col, Y_col, X_order, text_series, hue_col = None, 
+                       hue_order = None,  annotation_kwargs = {}, box_stats = None, **kwargs):
+    """
+    This function draws strings from a pandas series (text_series) at the X centre and Y max
+    for each box ontop of the mathplotlib.axes object.
+    
+    box_stats (default = None): The box_stats_table of df, computed here if not given. Boxes without data or text 
+    are skipped.
+    """
+    if box_stats is None: box_stats = box_stats_table(df, Y_col, X_col, X_order, hue_col = hue_col, hue_order = hue_order)
     # determine text allignment
     ha, va = 'center', 'bottom'
     if 'rotation' in kwargs:
         if kwargs['rotation'] == 'vertical': ha, va = 'left', 'center'
     if 'rotation' in annotation_kwargs:
         if annotation_kwargs['rotation'] == 'vertical': ha, va = 'left', 'center'
-    # annotate above each box
-    i = 0
-    if hue_col is not None: 
-        for group in X_order:
-            for hue in hue_order:
-                y = box_maxs_series.loc[(group,hue)] + (df[Y_col].max()/50) #offset slighly above the max value
-                x = box_centre_X_list[i]
-                text = text_series.loc[(group,hue)]
-                ax.annotate(s = text, xy = (x,y), ha=ha, va=va, **kwargs, **annotation_kwargs)
-                i +=1
-    else:
-        for group in X_order:
-            y = box_maxs_series.loc[(group)] + (df[Y_col].max()/50) #offset slighly above the max value
-            x = box_centre_X_list[i]
-            text = text_series.loc[(group)]
-            ax.annotate(s = text, xy = (x,y), ha=ha, va=va, **kwargs, **annotation_kwargs)
-            i +=1
+    # annotate above each box, offset slighly above the max value
+    boxes = box_stats.assign(text = text_series.reindex(box_stats.index).to_numpy()).dropna(subset = ['max', 'text'])
+    y = boxes['max'].to_numpy() + boxes['max'].max() / 50
+    for x, y, text in zip(boxes['x'].to_numpy(), y, boxes['text'].to_numpy()):
+        ax.annotate(text, xy = (x,y), ha=ha, va=va, **kwargs, **annotation_kwargs)
 
 def posthoc_letter_boxplot(df, Y_col, X_col, hue_col, X_order, hue_order, post_hoc = "tukey", alpha = 0.05, 
                            fig_path = None, hue_palette = "YlGn", xtick_kwargs = {}, ytick_kwargs = {}, 
-                           annotation_kwargs = {}, savefig_kwargs = {}):
+                           annotation_kwargs = {}, savefig_kwargs = {}, ax = None, overlay_kwargs = {}):
     """
     Function draws a grouped custom boxplot with significance caluclaed for a given posthoc test. Significance is 
     represented as letters where boxes sharing the same letter are not significant
+    
+    One box_stats_table feeds the y limits, the medians ordering the letters and the annotation positions.
+    overlay_kwargs are passed to grouped_boxplot_with_overlay (overlay, max_points_per_box...); the boxes and letters 
+    always use every row.
+    
+    Returns (fig, ax, df) as grouped_boxplot_with_overlay. With ax (see grouped_boxplot_with_overlay) the plot is 
+    drawn on it and only saved when fig_path is given, never shown.
     """
+    show = ax is None
     grouping_cols = [X_col]
     if hue_col is not None: grouping_cols.append(hue_col)
-    fig, ax, df1 = grouped_boxplot_with_overlay(df, Y_col, X_col, hue_col, X_order, hue_order, 
-                                               xtick_kwargs = xtick_kwargs, ytick_kwargs = ytick_kwargs)       
-    median_df= df1.groupby(grouping_cols)[Y_col].median().to_frame()
-    if hue_col != None:
-        for row in median_df.index:
-            median_df.loc[row, 'comb'] = str(row[0]) + "│" + str(row[1])
-        median_df.set_index('comb', drop = True, inplace = True)
-        df1['comb'] = df1[X_col].map(str) + "│" + df1[hue_col].map(str)
-        results_df = post_hoc_df(df1, Y_col, 'comb', posthoc = post_hoc, alpha = alpha)
-    else: results_df = post_hoc_df(df1, Y_col, X_col, posthoc = post_hoc, alpha = alpha)
-    
-    letters_df = multi_comparisons_letter_df_generator(results_df, letter_ordering_series = median_df[Y_col])
-    if hue_col != None:
-        for row in letters_df.index:
-                X_group, Hue_group = row.split("│")
-                letters_df.loc[row,'Hue group'] = type(hue_order[0])(Hue_group)
-                letters_df.loc[row,'X group'] = type(X_order[0])(X_group)
-        letters_df.set_index(['X group', 'Hue group'], inplace = True, drop = True)
+    df1 = _plotted_rows(df, X_col, hue_col, X_order, hue_order)
+    box_stats = box_stats_table(df1, Y_col, X_col, X_order, hue_col = hue_col, hue_order = hue_order)
+    fig, ax, df1 = grouped_boxplot_with_overlay(df1, Y_col, X_col, hue_col, X_order, hue_order, hue_palette = hue_palette, 
+                                               xtick_kwargs = xtick_kwargs, ytick_kwargs = ytick_kwargs, ax = ax, 
+                                               box_stats = box_stats, **overlay_kwargs)       
+    letters_df = posthoc_letters(df1, Y_col, grouping_cols, posthoc = post_hoc, alpha = alpha, 
+                                 letter_ordering_series = box_stats['median'])
     
     annotate_above_box(df1, ax, X_col, Y_col, X_order, text_series = letters_df['string'], hue_col = hue_col, hue_order = hue_order, 
-                       fontsize = 12, fontweight = 'bold', wrap = True, annotation_kwargs = annotation_kwargs)
+                       fontsize = 12, fontweight = 'bold', wrap = True, annotation_kwargs = annotation_kwargs, 
+                       box_stats = box_stats)
     #plot figure
-    if fig_path is not None: plt.savefig(fig_path, **savefig_kwargs)
-    else: plt.show() 
+    if fig_path is not None: fig.savefig(fig_path, **savefig_kwargs)
+    elif show: 
+        import matplotlib.pyplot as plt
+        plt.show() 
+    return fig, ax, df1
+
+_renderer_df = None
+_renderer_figure = None
+
+def _init_renderer(df):
+    """
+    Worker initializer: Agg backend and the shared df, sent once per worker instead of once per job
+    """
+    global _renderer_df
+    import matplotlib
+    matplotlib.use('Agg')
+    _renderer_df = df
+
+def _render_job(job, df = None):
+    """
+    Draws and saves one job of render_boxplots on a Figure that is cleared and reused between the jobs of a process
+    """
+    global _renderer_figure
+    import matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    if df is None: df = _renderer_df
+    job = dict(job)
+    fig_path, savefig_kwargs = job.pop('fig_path'), job.pop('savefig_kwargs', {})
+    start = time.perf_counter()
+    with matplotlib.rc_context(BOXPLOT_RC):
+        if _renderer_figure is None:
+            _renderer_figure = Figure()
+            FigureCanvasAgg(_renderer_figure)
+        fig = _renderer_figure
+        fig.clear()
+        ax = fig.add_subplot(1, 1, 1)
+        _, ax, df1 = posthoc_letter_boxplot(df, ax = ax, **job)
+        fig.set_size_inches(_figure_width(df1, job['X_col'], job.get('hue_col')), 5)
+        drawn = time.perf_counter()
+        fig.savefig(fig_path, **savefig_kwargs)
+    saved = time.perf_counter()
+    return {'fig_path': str(fig_path), 'Y_col': job['Y_col'], 'Draw seconds': drawn - start, 
+            'Save seconds': saved - drawn, 'Seconds': saved - start, 'pid': os.getpid()}
+
+def render_boxplots(df, jobs, n_jobs = None, executor = None):
+    """
+    Renders many posthoc_letter_boxplot figures headlessly and returns a df with the timings of each figure 
+    (draw, i.e. post hoc test, letters and artists, and save) in job order.
+    
+    Each job is a dict of posthoc_letter_boxplot keyword arguments (without df), which must include fig_path; the 
+    file format (PNG/SVG/PDF...) follows its suffix. Figures are drawn object-oriented on the Agg canvas under 
+    matplotlib.rc_context(BOXPLOT_RC), so no pyplot or global rc state is involved, and each process reuses one 
+    Figure across its jobs.
+    
+    n_jobs (default = None): Number of worker processes the jobs are spread across, -1 for every CPU. df is sent to 
+    each worker once.
+    executor (default = None): A concurrent.futures executor to use instead of starting a process pool. Its workers 
+    must have been started with initializer = _init_renderer, initargs = (df,).
+    """
+    n_workers = core.worker_count(n_jobs)
+    if executor is None and n_workers > 1:
+        with ProcessPoolExecutor(max_workers = n_workers, initializer = _init_renderer, initargs = (df,)) as pool:
+            return render_boxplots(df, jobs, executor = pool)
+    if executor is None: timings = [_render_job(job, df) for job in jobs]
+    else: timings = list(executor.map(_render_job, jobs))
+    return pd.DataFrame(timings)
 
 if __name__ == "__main__":
 
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Command line and batch entry point for 'Python pairwise comparison letter generator'
+
+Letters one dataset:
+
+    python pairwisecomp_batch.py letters data.csv --Y-cols height weight --group-cols treatment --output letters.csv
+
+or every job of a manifest on a pool of warm worker processes, writing each letters table as soon as its job
+finishes and skipping the jobs a previous (interrupted) run already finished:
+
+    python pairwisecomp_batch.py batch jobs.json --output-dir letters --n-jobs -1
+
+Github: PhilPlantMan
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import pairwisecomp_core as core
+from pairwisecomp_letters import posthoc_letters_batch
+
+JOB_KEYS = ('name', 'dataset', 'Y_cols', 'group_cols', 'strata_cols', 'posthoc', 'alpha', 'output')
+LEDGER = 'completed_jobs.jsonl'
+
+def load_manifest(path):
+    """
+    Returns the jobs of a manifest: a JSON list of job dicts, or JSON Lines with one job dict per line. A job has
+    'dataset' (a CSV or Parquet path, relative to the manifest), 'Y_cols' and 'group_cols' (a column name or
+    list), and optionally 'strata_cols', 'posthoc' (default "tukey"), 'alpha' (default 0.05), 'name' (default
+    <dataset file name>-<hash of the job>, so it does not change when other jobs are added or moved), 'output'
+    (default <name>.<format> in the output directory) and any keyword argument of
+    multi_comparisons_letter_df_generator (e.g. random_state, engine). Raises ValueError for a manifest that is not
+    valid JSON, a job without one of the required keys, and job names or outputs that are not unique.
+    """
+    with open(path) as file: text = file.read()
+    if text.lstrip().startswith('['): jobs = json.loads(text)
+    else: jobs = [json.loads(line) for line in text.splitlines() if line.strip()]
+    directory = os.path.dirname(os.path.abspath(path))
+    for number, job in enumerate(jobs):
+        if not isinstance(job, dict): raise ValueError("job {} of {} is not a JSON object".format(number, path))
+        missing = [key for key in ('dataset', 'Y_cols', 'group_cols') if key not in job]
+        if missing: raise ValueError("job {} of {} has no {}".format(number, path, ", ".join(missing)))
+        job.setdefault('name', default_job_name(job))
+        job['dataset'] = os.path.join(directory, job['dataset'])
+    names = [job['name'] for job in jobs]
+    if len(set(names)) < len(names): raise ValueError("job names in {} are not unique".format(path))
+    outputs = [os.path.normpath(job['output']) for job in jobs if job.get('output')]
+    if len(set(outputs)) < len(outputs): raise ValueError("job outputs in {} are not unique".format(path))
+    return jobs
+
+def default_job_name(job):
+    """
+    Returns <dataset file name>-<first 8 hex digits of a sha256 of the job>, e.g. 'trial1-3f2a9c1d'
+    """
+    stem = os.path.splitext(os.path.basename(job['dataset']))[0]
+    digest = hashlib.sha256(json.dumps(job, sort_keys = True, default = str).encode()).hexdigest()
+    return '{}-{}'.format(stem, digest[:8])
+
+def _as_list(cols):
+    if cols is None: return []
+    return [cols] if isinstance(cols, str) else list(cols)
+
+def job_fingerprint(job):
+    """
+    Returns a sha256 hex digest of the job and of the size and modification time of its dataset, so a job is run
+    again on resume when either changed
+    """
+    try: status = os.stat(job['dataset'])
+    except OSError: stamp = None # the job fails when it runs and is recorded as failed
+    else: stamp = [status.st_size, status.st_mtime_ns]
+    text = json.dumps([job, stamp], sort_keys = True, default = str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def output_path(job, output_dir, output_format):
+    if job.get('output'): return os.path.join(output_dir, job['output'])
+    return os.path.join(output_dir, '{}.{}'.format(job['name'], output_format))
+
+def read_dataset(path, columns):
+    """
+    Reads only columns from a CSV or Parquet (.parquet/.pq) file
+    """
+    if str(path).lower().endswith(('.parquet', '.pq')): return pd.read_parquet(path, columns = columns)
+    return pd.read_csv(path, usecols = columns)
+
+def write_table(df, path):
+    """
+    Writes df as Parquet (.parquet/.pq) or CSV, through a temporary file that is renamed when complete, so an
+    interrupted write never leaves a table that looks finished
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok = True)
+    temporary = os.path.join(directory, '.{}.{}.tmp'.format(os.path.basename(path), os.getpid()))
+    if str(path).lower().endswith(('.parquet', '.pq')): df.to_parquet(temporary, index = False)
+    else: df.to_csv(temporary, index = False)
+    os.replace(temporary, path)
+
+def run_job(job, path):
+    """
+    Reads the dataset of job, letters every Y column (and stratum) with posthoc_letters_batch, writes the table to
+    path and returns a summary dict. Top level so it can run in worker processes.
+    """
+    start = time.perf_counter()
+    Y_cols, group_cols, strata_cols = _as_list(job['Y_cols']), _as_list(job['group_cols']), _as_list(job.get('strata_cols'))
+    letter_kwargs = {key: value for key, value in job.items() if key not in JOB_KEYS}
+    df = read_dataset(job['dataset'], list(dict.fromkeys(strata_cols + group_cols + Y_cols)))
+    read = time.perf_counter()
+    letters = posthoc_letters_batch(df, Y_cols, group_cols, strata_cols = strata_cols or None,
+                                    posthoc = job.get('posthoc', "tukey"), alpha = job.get('alpha', 0.05), **letter_kwargs)
+    lettered = time.perf_counter()
+    write_table(letters, path)
+    return {'name': job['name'], 'output': path, 'rows': len(df), 'groups': len(letters),
+            'Read seconds': read - start, 'Letters seconds': lettered - read,
+            'Seconds': time.perf_counter() - start, 'pid': os.getpid()}
+
+def warm_worker():
+    """
+    Worker initializer: imports the statistics packages post_hoc_df loads lazily, so the first job of each worker
+    does not pay for them
+    """
+    for module in ('scipy.stats', 'statsmodels.stats.multicomp', 'statsmodels.stats.multitest', 'scikit_posthocs'):
+        importlib.import_module(module)
+
+def completed_jobs(ledger_path, statuses = ('done',)):
+    """
+    Returns {job name: fingerprint} of the jobs whose last record in the ledger has one of statuses
+    """
+    records = {}
+    if not os.path.exists(ledger_path): return records
+    with open(ledger_path) as file:
+        for line in file:
+            try: record = json.loads(line)
+            except ValueError: continue # a line cut short by an interruption
+            records[record['name']] = record
+    return {name: record['fingerprint'] for name, record in records.items() if record['status'] in statuses}
+
+def run_manifest(jobs, output_dir, output_format = 'parquet', n_jobs = None, executor = None, resume = True,
+                 retry_failed = True, progress = None):
+    """
+    Runs jobs (see load_manifest) and returns the list of their summaries in the order they finished. Each table
+    is written, and the job recorded in the ledger file output_dir/completed_jobs.jsonl, as soon as the job
+    finishes. With resume, jobs the ledger records as done, with an unchanged job and dataset and an existing
+    output, are skipped. A failed job is recorded with its error and does not stop the others; without
+    retry_failed, jobs that failed with an unchanged job and dataset are skipped too.
+
+    n_jobs (default = None): Number of worker processes, -1 for every CPU. Jobs run in the calling process for
+    None or 1.
+    executor (default = None): A concurrent.futures executor to reuse across calls (e.g. a ProcessPoolExecutor
+    with initializer = warm_worker), instead of starting a pool for this call.
+    """
+    paths = [os.path.normpath(output_path(job, output_dir, output_format)) for job in jobs]
+    if len(set(paths)) < len(paths):
+        raise ValueError("more than one job writes {}".format(next(path for path in paths if paths.count(path) > 1)))
+    os.makedirs(output_dir, exist_ok = True)
+    ledger_path = os.path.join(output_dir, LEDGER)
+    done = completed_jobs(ledger_path) if resume else {}
+    failed = {} if retry_failed else completed_jobs(ledger_path, ('failed',))
+    pending, summaries = [], []
+    for job in jobs:
+        path, fingerprint = output_path(job, output_dir, output_format), job_fingerprint(job)
+        if (done.get(job['name']) == fingerprint and os.path.exists(path)) or failed.get(job['name']) == fingerprint:
+            summaries.append({'name': job['name'], 'output': path, 'status': 'skipped'})
+            if progress is not None: progress(summaries[-1])
+        else: pending.append((job, path, fingerprint))
+    if executor is None and core.worker_count(n_jobs) > 1:
+        with ProcessPoolExecutor(max_workers = core.worker_count(n_jobs), initializer = warm_worker) as pool:
+            return summaries + run_manifest([job for job, _, _ in pending], output_dir, output_format,
+                                            executor = pool, resume = False, progress = progress)
+    if executor is None: finished = (_run_and_catch(job, path, fingerprint) for job, path, fingerprint in pending)
+    else:
+        futures = [executor.submit(_run_and_catch, job, path, fingerprint) for job, path, fingerprint in pending]
+        finished = (future.result() for future in as_completed(futures))
+    with open(ledger_path, 'a') as ledger:
+        for summary in finished:
+            ledger.write(json.dumps({key: summary[key] for key in ('name', 'fingerprint', 'status', 'error')
+                                     if key in summary}) + '\n')
+            ledger.flush()
+            summaries.append(summary)
+            if progress is not None: progress(summary)
+    return summaries
+
+def _run_and_catch(job, path, fingerprint):
+    try: summary = dict(run_job(job, path), status = 'done')
+    except Exception as error:
+        summary = {'name': job['name'], 'output': path, 'status': 'failed',
+                   'error': ''.join(traceback.format_exception_only(type(error), error)).strip()}
+    summary['fingerprint'] = fingerprint
+    return summary
+
+def _print_summary(summary):
+    if summary['status'] == 'done':
+        print("{name}: {groups} lettered groups from {rows} rows in {Seconds:.2f} s -> {output}".format(**summary), flush = True)
+    elif summary['status'] == 'skipped': print("{name}: already done -> {output}".format(**summary), flush = True)
+    else: print("{}: failed: {}".format(summary['name'], summary['error'].splitlines()[0]), file = sys.stderr, flush = True)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Letter representations of pairwise comparisons for datasets")
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    single = commands.add_parser('letters', help = "letter one dataset")
+    single.add_argument('dataset', help = "CSV or Parquet file")
+    single.add_argument('--Y-cols', nargs = '+', required = True)
+    single.add_argument('--group-cols', nargs = '+', required = True)
+    single.add_argument('--strata-cols', nargs = '+')
+    single.add_argument('--posthoc', default = "tukey", choices = ["tukey", "dunn", "Statsmodels_tukey"])
+    single.add_argument('--alpha', type = float, default = 0.05)
+    single.add_argument('--random-state', type = int)
+    single.add_argument('--engine', default = "sweep", choices = ["sweep", "clique"])
+    single.add_argument('--output', help = "CSV or Parquet file (default: print the table)")
+    batch = commands.add_parser('batch', help = "run the jobs of a manifest on warm worker processes")
+    batch.add_argument('manifest', help = "JSON list or JSON Lines of jobs, see load_manifest")
+    batch.add_argument('--output-dir', default = 'letters')
+    batch.add_argument('--format', default = 'parquet', choices = ['parquet', 'csv'])
+    batch.add_argument('--n-jobs', type = int, default = -1, help = "worker processes, -1 for every CPU")
+    batch.add_argument('--no-resume', action = 'store_true', help = "run every job even if it was done before")
+    batch.add_argument('--watch', type = float, metavar = 'SECONDS',
+                       help = "keep the workers running and check the manifest for new jobs every SECONDS")
+    args = parser.parse_args(argv)
+
+    if args.command == 'letters':
+        df = read_dataset(args.dataset, list(dict.fromkeys((args.strata_cols or []) + args.group_cols + args.Y_cols)))
+        letters = posthoc_letters_batch(df, args.Y_cols, args.group_cols, strata_cols = args.strata_cols,
+                                        posthoc = args.posthoc, alpha = args.alpha, random_state = args.random_state,
+                                        engine = args.engine)
+        if args.output: write_table(letters, args.output)
+        else: print(letters.to_string(index = False))
+        return 0
+
+    n_workers = core.worker_count(args.n_jobs)
+    with ProcessPoolExecutor(max_workers = n_workers, initializer = warm_worker) as pool:
+        resume, retry_failed, progress = not args.no_resume, True, _print_summary
+        manifest_error = None
+        while True:
+            try:
+                summaries = run_manifest(load_manifest(args.manifest), args.output_dir, args.format, executor = pool,
+                                         resume = resume, retry_failed = retry_failed, progress = progress)
+            except (OSError, ValueError) as error:
+                # e.g. a manifest caught mid-edit: watch mode keeps the workers and reads it again on the next poll
+                if str(error) != manifest_error: print("{}: {}".format(args.manifest, error), file = sys.stderr, flush = True)
+                if args.watch is None: return 2
+                manifest_error, summaries = str(error), []
+            else: manifest_error = None
+            failed = sum(summary['status'] == 'failed' for summary in summaries)
+            if args.watch is None: return 1 if failed else 0
+            # later passes only run (and report) new or changed jobs
+            resume, retry_failed = True, False
+            progress = lambda summary: summary['status'] == 'skipped' or _print_summary(summary)
+            try: time.sleep(args.watch)
+            except KeyboardInterrupt: return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,667 @@
+# -*- coding: utf-8 -*-
+"""
+NumPy core of the 'Python pairwise comparison letter generator'
+
+Groups are integer indices and letters are columns of a boolean group x letter
+matrix, so the insert, absorb and sweep stages of Piepho (2004) run as array
+operations instead of pandas cell access.
+
+Github: PhilPlantMan
+"""
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import string
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+FITNESS_PARAMETERS = ("Min letters per row", "Number of different letters", "Letter total")
+# most sets insert_stage tracks to reproduce the literal column order before it falls back to the final letters
+INSERT_TRACKING_LIMIT = 2048
+
+
+def _pack_rows(family):
+    """
+    Packs the rows of a boolean matrix into uint64 words
+    """
+    packed = np.packbits(family, axis=1)
+    words = np.zeros((packed.shape[0], -(-packed.shape[1] // 8) * 8), dtype=np.uint8)
+    words[:, :packed.shape[1]] = packed
+    return words.view(np.uint64)
+
+
+def _contained(packed_a, packed_b):
+    """
+    Boolean matrix marking rows of packed_a that are subsets of rows of packed_b
+    """
+    if packed_a.shape[1] == 1: return (packed_a & ~packed_b.T) == 0
+    return ~(packed_a[:, None, :] & ~packed_b[None, :, :]).any(axis=2)
+
+
+def _split_letters(family, g1, g2):
+    """
+    Splits the letters (rows) held by both groups into a copy without g1 and a copy without g2
+    """
+    hit = family[:, g1] & family[:, g2]
+    kept, duplicated = family[hit], family[hit]
+    kept[:, g1] = False
+    duplicated[:, g2] = False
+    return hit, kept, duplicated
+
+
+def _maximal_letters(n_groups, group1, group2, reject):
+    """
+    Insert stage absorbing after every split, as Piepho (2004) describes. Returns the final letters as a boolean
+    letter x group matrix and its packed rows, which are the same sets the insert-all-then-absorb order ends with.
+    """
+    family = np.ones((1, n_groups), dtype=bool)
+    packed = _pack_rows(family)
+    for g1, g2 in zip(group1[reject], group2[reject]):
+        hit, kept, duplicated = _split_letters(family, g1, g2)
+        if not hit.any(): continue
+        family, packed, new_sets = family[~hit], packed[~hit], np.concatenate((kept, duplicated))
+        new_packed = _pack_rows(new_sets)
+        _, first = np.unique(new_packed, axis=0, return_index=True)
+        new_sets, new_packed = new_sets[first], new_packed[first]
+        # an unchanged letter was maximal and stays so, only the new letters can be absorbed
+        in_new = _contained(new_packed, new_packed)
+        np.fill_diagonal(in_new, False)
+        absorbed = _contained(new_packed, packed).any(axis=1) | in_new.any(axis=1)
+        family = np.concatenate((family, new_sets[~absorbed]))
+        packed = np.concatenate((packed, new_packed[~absorbed]))
+    return family, packed
+
+
+def insert_stage(n_groups, group1, group2, reject, stats=None):
+    """
+    'Insert' stage: starting from a single letter shared by all groups, every letter held by both groups of a
+    significant pair is duplicated, the group1 cell is deleted from the original letter and the group2 cell
+    from the duplicate. Duplicates are appended after the existing letters in the order they were visited.
+
+    Done literally the number of letters grows exponentially, so the letters are held as distinct sets of
+    groups, each keyed by the position of its last copy. A set is pruned as soon as a superset with a later
+    position exists: everything it would produce is a subset of, or an earlier copy of, something the
+    superset produces, and so it could never survive the 'Absorb' stage. Sets that hold none of the letters
+    the stages end with are pruned as well. Returns the remaining letters as a group x letter matrix in
+    position order.
+
+    Some patterns (e.g. long chains of overlapping groups) still leave exponentially many sets to track. Once more
+    than INSERT_TRACKING_LIMIT are, the letters the stages end with are returned directly, in the order the
+    absorbing insert of Piepho (2004) finds them, which only changes the column order.
+
+    stats (default = None): A dict that is filled with 'Column duplications' (letters split in two, counting each
+    distinct tracked set once rather than each literal copy) and 'Peak letters tracked'.
+    """
+    final, final_packed = _maximal_letters(n_groups, group1, group2, reject)
+    family = np.ones((1, n_groups), dtype=bool)
+    packed = _pack_rows(family)
+    position = np.zeros(1, dtype=np.intp)
+    duplications, peak = 0, 1
+    for g1, g2 in zip(group1[reject], group2[reject]):
+        hit, kept, duplicated = _split_letters(family, g1, g2)
+        if not hit.any(): continue
+        duplications += int(hit.sum())
+        new_sets = np.concatenate((kept, duplicated))
+        new_position = np.concatenate((position[hit], position.max() + 1 + position[hit]))
+        family, packed, position = family[~hit], packed[~hit], position[~hit]
+        # keep the latest copy of each distinct new set that can still end as a final letter
+        new_packed = _pack_rows(new_sets)
+        latest_first = np.argsort(-new_position)
+        _, first = np.unique(new_packed[latest_first], axis=0, return_index=True)
+        latest = latest_first[first]
+        latest = latest[_contained(final_packed, new_packed[latest]).any(axis=0)]
+        new_sets, new_packed, new_position = new_sets[latest], new_packed[latest], new_position[latest]
+        # a set equal to an unchanged set keeps the later position of the two
+        same = (new_packed[:, None, :] == packed[None, :, :]).all(axis=2)
+        later_copy = (same & (position[None, :] > new_position[:, None])).any(axis=1)
+        same &= ~later_copy[:, None]
+        new_sets, new_packed, new_position, same = (new_sets[~later_copy], new_packed[~later_copy],
+                                                    new_position[~later_copy], same[~later_copy])
+        replaced = same.any(axis=0)
+        family, packed, position = family[~replaced], packed[~replaced], position[~replaced]
+        # prune sets contained in a later set, only pairs involving a new set can have changed
+        new_in_new = _contained(new_packed, new_packed)
+        np.fill_diagonal(new_in_new, False)
+        new_pruned = ((_contained(new_packed, packed) & (position[None, :] > new_position[:, None])).any(axis=1)
+                      | (new_in_new & (new_position[None, :] > new_position[:, None])).any(axis=1))
+        old_pruned = (_contained(packed, new_packed) & (new_position[None, :] > position[:, None])).any(axis=1)
+        family = np.concatenate((family[~old_pruned], new_sets[~new_pruned]))
+        packed = np.concatenate((packed[~old_pruned], new_packed[~new_pruned]))
+        position = np.concatenate((position[~old_pruned], new_position[~new_pruned]))
+        in_order = np.argsort(position)
+        family, packed, position = family[in_order], packed[in_order], np.arange(family.shape[0])
+        peak = max(peak, family.shape[0])
+        if family.shape[0] > INSERT_TRACKING_LIMIT:
+            family = final
+            break
+    if stats is not None: stats.update({"Column duplications": duplications, "Peak letters tracked": peak})
+    return family.T.copy()
+
+
+def absorb_stage(letters):
+    """
+    'Absorb' stage: visiting letters from first to last, a letter is dropped when its groups are a subset of
+    the groups of any other remaining letter. Columns are bit packed so each subset test is a byte comparison.
+    """
+    packed = np.packbits(letters, axis=0)
+    alive = np.ones(letters.shape[1], dtype=bool)
+    for col in range(letters.shape[1]):
+        alive[col] = False
+        if alive.any():
+            outside = packed[:, [col]] & ~packed[:, alive]
+            if not outside.any(axis=0).all(): continue
+        alive[col] = True
+    return letters[:, alive]
+
+
+def letters_valid(letters, group1, group2, reject):
+    """
+    Returns True if every group has a letter, no significant pair shares a letter and every non-significant
+    pair shares at least one letter
+    """
+    if not letters.any(axis=1).all(): return False
+    shared = (letters[group1] & letters[group2]).any(axis=1)
+    return bool(np.array_equal(shared, ~reject))
+
+
+def random_module_deletion_order(letters):
+    """
+    Order in which the letter cells are swept, drawn from the global random module exactly as the original
+    pandas implementation did: each cell, row by row, takes a random remaining number and cells are swept
+    from the lowest number. random.randrange(n) consumes the generator in the same way as
+    random.sample(num_list, 1).
+    """
+    n_cells = int(letters.sum())
+    num_list = list(range(n_cells))
+    ranks = np.array([num_list.pop(random.randrange(len(num_list))) for _ in range(n_cells)], dtype=np.intp)
+    order = np.empty(n_cells, dtype=np.intp)
+    order[ranks] = np.arange(n_cells)
+    return order
+
+
+def required_pairs(n_groups, group1, group2, reject):
+    """
+    Returns a symmetric boolean group x group matrix marking the non-significant pairs that must keep sharing
+    a letter
+    """
+    required = np.zeros((n_groups, n_groups), dtype=bool)
+    required[group1[~reject], group2[~reject]] = True
+    required[group2[~reject], group1[~reject]] = True
+    np.fill_diagonal(required, False)
+    return required
+
+
+def sweep_cycle(letters, required, order, representation_valid = True):
+    """
+    One 'sweep' cycle: letter cells are deleted one at a time in the given order (indices into the row-major
+    list of set cells) and a deletion is kept only if the letters still represent the comparisons. Letters
+    left without any group are dropped.
+
+    Deleting a cell can only break the pairs of its own group, so instead of rechecking every comparison
+    a group x group count of shared letters is kept (its diagonal is the number of letters of each group).
+    A deletion is valid if the group keeps a letter and every required partner that held the deleted letter
+    still shares another one. Significant pairs cannot start sharing a letter through a deletion. If the
+    starting letters do not represent the comparisons (representation_valid = False) no deletion can make
+    them valid and none is made.
+    """
+    current = letters.copy()
+    if representation_valid:
+        shared = letters.astype(np.intp) @ letters.T.astype(np.intp)
+        rows, cols = np.nonzero(letters)
+        for cell in order:
+            row, col = rows[cell], cols[cell]
+            partners = np.flatnonzero(current[:, col])
+            partner_shared = shared[row, partners]
+            if shared[row, row] == 1 or (required[row, partners] & (partner_shared == 1)).any(): continue
+            current[row, col] = False
+            shared[row, partners] = partner_shared - 1
+            shared[partners, row] = partner_shared - 1
+    return current[:, current.any(axis=0)]
+
+
+def fitness(letters):
+    """
+    Returns the optimisation parameters of a letter matrix
+    """
+    row_totals = letters.sum(axis=1)
+    return {"Min letters per row": int(row_totals.max()),
+            "Number of different letters": letters.shape[1],
+            "Letter total": int(row_totals.sum())}
+
+
+def fitter(candidate, best, primary_optimisation_parameter):
+    """
+    True if the candidate fitness beats the best so far: lower primary_optimisation_parameter first, then a
+    lower sum of all parameters
+    """
+    if candidate[primary_optimisation_parameter] != best[primary_optimisation_parameter]:
+        return candidate[primary_optimisation_parameter] < best[primary_optimisation_parameter]
+    return sum(candidate.values()) < sum(best.values())
+
+
+def sweep_cycles(letters, required, representation_valid, seeds):
+    """
+    Runs one sweep cycle per seed and returns the fitness and the letters of every cycle as two lists. A seed
+    is anything numpy.random.default_rng accepts; a seed of None draws the deletion order from the global
+    random module instead. Top level so it can run in worker processes.
+    """
+    n_cells = int(letters.sum())
+    fitnesses, cycle_letters = [], []
+    for seed in seeds:
+        if seed is None: order = random_module_deletion_order(letters)
+        else: order = np.random.default_rng(seed).permutation(n_cells)
+        cycle_letters.append(sweep_cycle(letters, required, order, representation_valid))
+        fitnesses.append(fitness(cycle_letters[-1]))
+    return fitnesses, cycle_letters
+
+
+def _seed_source(random_state, n_jobs, executor):
+    """
+    Returns a function giving the seeds of the next n cycles. Without a random_state, n_jobs or executor the
+    cycles use the global random module as they always have (seeds of None). Otherwise cycle i gets the i-th
+    child of numpy.random.SeedSequence(random_state), so it is the same whichever worker runs it.
+    """
+    if random_state is None and (n_jobs is None or n_jobs == 1) and executor is None:
+        return lambda n: [None] * n
+    return np.random.SeedSequence(random_state).spawn
+
+
+def worker_count(n_jobs, executor = None):
+    """
+    n_jobs, or every CPU for n_jobs = -1 or for an executor given without n_jobs
+    """
+    if n_jobs == -1 or (n_jobs is None and executor is not None): return os.cpu_count() or 1
+    return max(n_jobs or 1, 1)
+
+
+def run_sweep_cycles(letters, required, representation_valid, primary_optimisation_parameter, monte_carlo_cycles = 5,
+                     random_state = None, n_jobs = None, executor = None, time_budget = None, patience = None,
+                     start_time = None):
+    """
+    Runs sweep cycles and returns (best letters, report). The first cycle with the best fitness wins.
+
+    Cycles run in the calling process or on n_jobs worker processes (-1 for every CPU). An executor (any
+    concurrent.futures.Executor) is used as given, otherwise a ProcessPoolExecutor is started when n_jobs > 1.
+    With a fixed number of cycles each worker gets one contiguous chunk, so the letters are shipped to it
+    once. Results are reduced in cycle order, so for a given random_state they do not depend on the number
+    of workers.
+
+    Anytime mode: monte_carlo_cycles may be None (no limit) when a stopping rule is given. time_budget stops
+    after the cycle (or round of one cycle per worker) that uses up that many seconds since start_time.
+    patience stops once that many cycles in a row have not improved on the best; this is decided in cycle
+    order so it is reproducible too. At least one cycle always runs.
+
+    The report is a dict with 'Cycles run', 'Best cycle', 'Best fitness', 'Fitness history' (fitness of every
+    cycle), 'Best fitness history' (best primary_optimisation_parameter after every cycle), 'Stopped by'
+    and 'Seconds'.
+    """
+    if start_time is None: start_time = time.perf_counter()
+    if monte_carlo_cycles is None and time_budget is None and patience is None:
+        raise ValueError("monte_carlo_cycles can only be None with a time_budget or patience")
+    n_workers = worker_count(n_jobs, executor)
+    if n_workers > 1 and executor is None:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            return run_sweep_cycles(letters, required, representation_valid, primary_optimisation_parameter,
+                                    monte_carlo_cycles, random_state, n_workers, pool, time_budget, patience,
+                                    start_time)
+    next_seeds = _seed_source(random_state, n_jobs, executor)
+    anytime = time_budget is not None or patience is not None
+    fitnesses, best_history = [], []
+    best_cycle, best_fitness, best = None, None, None
+    stopped_by = None
+    while stopped_by is None:
+        remaining = np.inf if monte_carlo_cycles is None else monte_carlo_cycles - len(fitnesses)
+        cycles_per_task = 1 if anytime else int(-(-remaining // n_workers))
+        seeds = next_seeds(int(min(remaining, cycles_per_task * n_workers)))
+        chunks = [seeds[i:i + cycles_per_task] for i in range(0, len(seeds), cycles_per_task)]
+        if executor is None:
+            results = [sweep_cycles(letters, required, representation_valid, chunk) for chunk in chunks]
+        else:
+            futures = [executor.submit(sweep_cycles, letters, required, representation_valid, chunk) for chunk in chunks]
+            results = [future.result() for future in futures]
+        for chunk_fitnesses, chunk_letters in results:
+            for cycle_fitness, current in zip(chunk_fitnesses, chunk_letters):
+                fitnesses.append(cycle_fitness)
+                if best_fitness is None or fitter(cycle_fitness, best_fitness, primary_optimisation_parameter):
+                    best_cycle, best_fitness, best = len(fitnesses) - 1, cycle_fitness, current
+                best_history.append(best_fitness[primary_optimisation_parameter])
+                if patience is not None and len(fitnesses) - 1 - best_cycle >= patience: stopped_by = "patience"
+                elif len(fitnesses) == monte_carlo_cycles: stopped_by = "monte_carlo_cycles"
+                if stopped_by is not None: break
+            if stopped_by is not None: break
+        if stopped_by is None and time_budget is not None and time.perf_counter() - start_time >= time_budget:
+            stopped_by = "time_budget"
+    report = {"Cycles run": len(fitnesses), "Best cycle": best_cycle, "Best fitness": best_fitness,
+              "Fitness history": fitnesses, "Best fitness history": best_history, "Stopped by": stopped_by,
+              "Seconds": time.perf_counter() - start_time}
+    return best, report
+
+
+def record_seconds(stats, key, since):
+    """
+    Stores the seconds since `since` under key in stats, unless stats is None, and returns the current time
+    """
+    now = time.perf_counter()
+    if stats is not None: stats[key] = now - since
+    return now
+
+
+def sweep_statistics(letters, representation_valid, report):
+    """
+    Returns the sweep counters for the stats of letter_matrix, from the letters the cycles started with and the
+    report of run_sweep_cycles. Besides the full check of the starting letters every deletion is one
+    (incremental) validity check, and the deletions a cycle kept are the cells it started with less its
+    'Letter total', so nothing has to be counted during the sweep.
+    """
+    n_cells = int(letters.sum())
+    cycles = report["Fitness history"]
+    checks = n_cells * len(cycles) if representation_valid else 0
+    accepted = sum(n_cells - cycle_fitness["Letter total"] for cycle_fitness in cycles)
+    return {"Cycles run": len(cycles), "Cycle fitness": cycles, "Validity checks": checks + 1,
+            "Deletions accepted": accepted, "Deletions rejected": checks - accepted}
+
+
+def letter_matrix(n_groups, group1, group2, reject, primary_optimisation_parameter = "Number of different letters",
+                  monte_carlo_cycles = 5, random_state = None, n_jobs = None, executor = None, time_budget = None,
+                  patience = None, return_report = False, stats = None):
+    """
+    Returns the boolean group x letter matrix with the best fitness after monte_carlo_cycles sweep cycles, or
+    (letters, report) with return_report = True. group1 and group2 are integer group indices of each
+    comparison and reject is a boolean array. The remaining parameters are described in run_sweep_cycles;
+    time_budget also counts the insert and absorb stages.
+
+    stats (default = None): A dict that is filled with 'Insert seconds', the counters of insert_stage, 'Letters
+    before absorb' (the letters the pruning insert leaves, which it has mostly absorbed already), 'Absorb seconds',
+    'Letters after absorb', 'Validity seconds', 'Representation valid', 'Sweep seconds' and the counters of
+    sweep_statistics. Without it only a clock read per stage is added.
+    """
+    start_time = time.perf_counter()
+    if primary_optimisation_parameter not in FITNESS_PARAMETERS:
+        raise ValueError("primary_optimisation_parameter must be one of {}".format(FITNESS_PARAMETERS))
+    if monte_carlo_cycles is not None and monte_carlo_cycles < 1:
+        raise ValueError("monte_carlo_cycles must be at least 1")
+    group1, group2 = np.asarray(group1, dtype=np.intp), np.asarray(group2, dtype=np.intp)
+    reject = np.asarray(reject, dtype=bool)
+    inserted = insert_stage(n_groups, group1, group2, reject, stats)
+    lap = record_seconds(stats, "Insert seconds", start_time)
+    letters = absorb_stage(inserted)
+    lap = record_seconds(stats, "Absorb seconds", lap)
+    required = required_pairs(n_groups, group1, group2, reject)
+    representation_valid = letters_valid(letters, group1, group2, reject)
+    lap = record_seconds(stats, "Validity seconds", lap)
+    best, report = run_sweep_cycles(letters, required, representation_valid, primary_optimisation_parameter,
+                                    monte_carlo_cycles, random_state, n_jobs, executor, time_budget, patience,
+                                    start_time)
+    record_seconds(stats, "Sweep seconds", lap)
+    if stats is not None:
+        stats.update({"Letters before absorb": inserted.shape[1], "Letters after absorb": letters.shape[1],
+                      "Representation valid": representation_valid})
+        stats.update(sweep_statistics(letters, representation_valid, report))
+    if return_report: return best, report
+    return best
+
+
+def _bits(mask):
+    """
+    Yields the indices of the set bits of an int
+    """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def maximal_cliques(adjacency):
+    """
+    Returns every maximal clique of a graph as an int bitset of vertices, using Bron-Kerbosch with pivoting.
+    adjacency is a list with the int bitset of the neighbours of each vertex.
+    """
+    cliques = []
+
+    def extend(clique, candidates, excluded):
+        if not candidates and not excluded:
+            cliques.append(clique)
+            return
+        pivot = max(_bits(candidates | excluded), key=lambda u: bin(candidates & adjacency[u]).count('1'))
+        for v in _bits(candidates & ~adjacency[pivot]):
+            extend(clique | 1 << v, candidates & adjacency[v], excluded & adjacency[v])
+            candidates &= ~(1 << v)
+            excluded |= 1 << v
+
+    extend(0, (1 << len(adjacency)) - 1, 0)
+    return cliques
+
+
+def _packing_bound(uncovered, element_cliques, element_order):
+    """
+    Lower bound on the number of cliques needed to cover the uncovered elements: the size of a greedy set of
+    elements no two of which any single clique covers
+    """
+    used, bound = 0, 0
+    for element in element_order:
+        if uncovered >> element & 1 and not element_cliques[element] & used:
+            used |= element_cliques[element]
+            bound += 1
+    return bound
+
+
+def clique_cover(n_groups, group1, group2, reject, max_nodes = 100000):
+    """
+    Letters with the fewest different letters as a cover by cliques of the graph of groups that are not
+    significantly different. A letter is a clique (so significant pairs never share one) and every
+    non-significant pair and every group must be covered. Only maximal cliques are needed, so these are
+    enumerated and the cover is solved as a set cover: greedily first, then by branch and bound limited to
+    max_nodes search nodes. Cells that can be removed afterwards are swept out.
+
+    Returns (letters, report). The report holds 'Number of different letters', 'Lower bound',
+    'Optimality gap', 'Optimal', 'Maximal cliques' and 'Search nodes'. The bound is exact when the search
+    finishes and otherwise a packing bound on the elements no clique can cover together.
+    """
+    group1, group2 = np.asarray(group1, dtype=np.intp), np.asarray(group2, dtype=np.intp)
+    reject = np.asarray(reject, dtype=bool)
+    adjacency = [((1 << n_groups) - 1) & ~(1 << group) for group in range(n_groups)]
+    for g1, g2 in zip(group1[reject], group2[reject]):
+        adjacency[g1] &= ~(1 << int(g2))
+        adjacency[g2] &= ~(1 << int(g1))
+    cliques = maximal_cliques(adjacency)
+    # elements to cover: every group and every required pair, as int bitsets of the cliques covering them
+    group_cliques = [sum(1 << c for c, clique in enumerate(cliques) if clique >> group & 1) for group in range(n_groups)]
+    required = required_pairs(n_groups, group1, group2, reject)
+    element_cliques = group_cliques + [group_cliques[u] & group_cliques[v] for u, v in zip(*np.nonzero(np.triu(required)))]
+    clique_elements = [sum(1 << e for e, covering in enumerate(element_cliques) if covering >> c & 1)
+                       for c in range(len(cliques))]
+    element_order = sorted(range(len(element_cliques)), key=lambda e: bin(element_cliques[e]).count('1'))
+    all_elements = (1 << len(element_cliques)) - 1
+    # greedy cover
+    best, uncovered = [], all_elements
+    while uncovered:
+        c = max(range(len(cliques)), key=lambda c: bin(clique_elements[c] & uncovered).count('1'))
+        best.append(c)
+        uncovered &= ~clique_elements[c]
+    root_bound = _packing_bound(all_elements, element_cliques, element_order)
+    # branch and bound on the element covered by the fewest cliques
+    nodes = 0
+
+    def search(uncovered, chosen):
+        nonlocal best, nodes
+        if nodes >= max_nodes: return False
+        nodes += 1
+        if not uncovered:
+            if len(chosen) < len(best): best = list(chosen)
+            return True
+        if len(chosen) + _packing_bound(uncovered, element_cliques, element_order) >= len(best): return True
+        element = min(_bits(uncovered), key=lambda e: bin(element_cliques[e]).count('1'))
+        covering = sorted(_bits(element_cliques[element]), key=lambda c: -bin(clique_elements[c] & uncovered).count('1'))
+        for c in covering:
+            chosen.append(c)
+            finished = search(uncovered & ~clique_elements[c], chosen)
+            chosen.pop()
+            if not finished: return False
+        return True
+
+    optimal = len(best) == root_bound or search(all_elements, [])
+    letters = np.array([[clique >> group & 1 for clique in (cliques[c] for c in best)] for group in range(n_groups)],
+                       dtype=bool).reshape(n_groups, len(best))
+    # letters ordered by their first group, then surplus cells swept out in row-major order
+    letters = letters[:, np.lexsort(letters[::-1])[::-1]]
+    letters = sweep_cycle(letters, required, np.arange(int(letters.sum())))
+    lower_bound = letters.shape[1] if optimal else root_bound
+    report = {"Number of different letters": letters.shape[1], "Lower bound": lower_bound,
+              "Optimality gap": letters.shape[1] - lower_bound, "Optimal": optimal,
+              "Maximal cliques": len(cliques), "Search nodes": nodes}
+    return letters, report
+
+
+def lettering_key(n_groups, group1, group2, reject, **parameters):
+    """
+    Canonical sha256 hex digest of a lettering problem: the number of groups, the group indices and reject pattern
+    of the comparisons in order, and any parameters that change the result (engine, optimisation parameter,
+    cycles, seed...). Group labels are not part of the key, so the same pattern over other labels hits the same
+    entry.
+    """
+    reject = np.asarray(reject, dtype=bool)
+    digest = hashlib.sha256(b'pairwisecomp letters v1')
+    digest.update(np.array([n_groups, reject.size], dtype=np.int64).tobytes())
+    digest.update(np.asarray(group1, dtype=np.int64).tobytes())
+    digest.update(np.asarray(group2, dtype=np.int64).tobytes())
+    digest.update(np.packbits(reject).tobytes())
+    digest.update(json.dumps(parameters, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class LetteringCache:
+    """
+    Cache of letter matrices and their reports keyed by lettering_key.
+
+    Entries are held in an in-memory LRU that evicts the least recently used entries once their size passes
+    max_bytes. With a path the entries are also written to a sqlite file, which is read on a memory miss and
+    survives the process. Letters are stored bit packed and reports as JSON.
+    """
+
+    def __init__(self, max_bytes = 64 * 2**20, path = None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._connection = None
+
+    def _database(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(str(self.path))
+            self._connection.execute("CREATE TABLE IF NOT EXISTS letters (key TEXT PRIMARY KEY, n_groups INTEGER, "
+                                     "n_letters INTEGER, bits BLOB, report TEXT)")
+        return self._connection
+
+    def _remember(self, key, entry):
+        if key in self._entries: self.nbytes -= self._entry_bytes(self._entries.pop(key))
+        self._entries[key] = entry
+        self.nbytes += self._entry_bytes(entry)
+        while self.nbytes > self.max_bytes and self._entries:
+            self.nbytes -= self._entry_bytes(self._entries.popitem(last=False)[1])
+
+    @staticmethod
+    def _entry_bytes(entry):
+        # packed letters and report JSON plus a rough allowance for the key and tuple
+        return len(entry[2]) + len(entry[3]) + 200
+
+    def get(self, key):
+        """
+        Returns (letters, report) for key, or None
+        """
+        entry = self._entries.get(key)
+        if entry is not None: self._entries.move_to_end(key)
+        elif self.path is not None:
+            entry = self._database().execute("SELECT n_groups, n_letters, bits, report FROM letters WHERE key = ?",
+                                             (key,)).fetchone()
+            if entry is not None: self._remember(key, entry)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        n_groups, n_letters, bits, report = entry
+        letters = np.unpackbits(np.frombuffer(bits, dtype=np.uint8), count=n_groups * n_letters).astype(bool)
+        return letters.reshape(n_groups, n_letters), json.loads(report)
+
+    def put(self, key, letters, report):
+        """
+        Stores the letters and report under key
+        """
+        entry = (letters.shape[0], letters.shape[1], np.packbits(letters).tobytes(), json.dumps(report, default=int))
+        self._remember(key, entry)
+        if self.path is not None:
+            with self._database() as connection:
+                connection.execute("INSERT OR REPLACE INTO letters VALUES (?, ?, ?, ?, ?)", (key,) + entry)
+
+    def clear(self):
+        """
+        Empties the in-memory LRU (the sqlite file is kept)
+        """
+        self._entries.clear()
+        self.nbytes = 0
+
+
+def comparison_letters(group1, group2, reject, ordering = None, letter_separator = '', engine = "sweep",
+                       max_search_nodes = 100000, **letter_matrix_kwargs):
+    """
+    NumPy only counterpart of pairwisecomp_letters.multi_comparisons_letter_df_generator for workers and scripts
+    that do not need pandas or the statistics packages. group1 and group2 are the labels of the two groups of
+    each comparison and reject marks the significant ones.
+
+    Returns (groups, strings): the group labels in order of first appearance and their letter strings. ordering
+    (a mapping from label to value, e.g. a dict of medians) orders the letters from the highest to the lowest
+    value. engine is "sweep" (letter_matrix, which gets letter_matrix_kwargs) or "clique" (clique_cover).
+    """
+    labels = np.concatenate((np.asarray(group1), np.asarray(group2)))
+    unique, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    appearance = np.argsort(first, kind='stable')
+    code = np.empty_like(appearance)
+    code[appearance] = np.arange(appearance.size)
+    codes = code[inverse.reshape(-1)]
+    groups, n_comparisons = unique[appearance], len(labels) // 2
+    group1, group2 = codes[:n_comparisons], codes[n_comparisons:]
+    reject = np.asarray(reject) == True
+    if engine == "clique": letters, _ = clique_cover(len(groups), group1, group2, reject, max_nodes=max_search_nodes)
+    elif engine == "sweep": letters = letter_matrix(len(groups), group1, group2, reject, **letter_matrix_kwargs)
+    else: raise ValueError("engine must be 'sweep' or 'clique'")
+    if ordering is not None:
+        letters = letters[:, letter_column_order(letters, [ordering[group] for group in groups])]
+    return groups, letter_strings(letters, letter_separator)
+
+
+def letter_column_order(letters, ordering):
+    """
+    Returns the column order that assigns letters from the highest to the lowest mean ordering value of the
+    groups holding each letter. Zero and NaN values are ignored in the means and ties are broken as
+    pandas.Series.sort_values(ascending = False) breaks them.
+    """
+    scores = letters * np.asarray(ordering, dtype=float)[:, None]
+    counted = (scores != 0) & ~np.isnan(scores)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counted, scores, 0).sum(axis=0) / counted.sum(axis=0)
+    # pandas nargsort: NaN last, descending order by reversing around a quicksort
+    nan_mask = np.isnan(means)
+    non_nan_idx = np.flatnonzero(~nan_mask)[::-1]
+    non_nan_order = non_nan_idx[means[non_nan_idx].argsort(kind='quicksort')][::-1]
+    return np.concatenate((non_nan_order, np.flatnonzero(nan_mask)))
+
+
+def letter_name(col):
+    """
+    Letter for column number col: a-z, then A-Z, then the same letters with a numeric suffix
+    """
+    if col < len(string.ascii_letters): return string.ascii_letters[col]
+    return string.ascii_letters[col % len(string.ascii_letters)] + str(col // len(string.ascii_letters))
+
+
+def letter_strings(letters, letter_separator = ''):
+    """
+    Returns a list with the letter string of each group (row), lettering the columns in order
+    """
+    column_letters = [letter_name(col) for col in range(letters.shape[1])]
+    return [letter_separator.join(column_letters[col] for col in np.flatnonzero(row)) for row in letters]
@@ -1,240 +1,418 @@
-# -*- coding: utf-8 -*-
-"""
-'Python pairwise comparison letter generator'
-
-Github: PhilPlantMan
-"""
-import pandas as pd
-import numpy as np
-import string
-import random
-import statsmodels.stats.multicomp as multi
-import scikit_posthocs as sp
-
-
-def multi_comparisons_letter_df_generator(comparisons_df, letter_ordering_series = None, 
-                                          primary_optimisation_parameter = "Number of different letters", 
-                                          monte_carlo_cycles = 5, letter_separator = '', ): 
-    """
-    Function takes a df listing pairwise comparisons with a cols labelled 'group1' and 'group2' for the two groups being compared 
-    and another column labelled 'reject' with boolean values corresponding to whether the null hypothesis should be rejected 
-    i.e. True: Both treatments are significantly different
-    
-    letter_ordering_series (default = None): In theory, which letters are assigned to each non-significance grouping is
-    arbitrary and therefor the order can be changed. Offering letter_ordering_series a series with the same index as the output
-    will make sure that the order that letters are assigned will follow letter_ordering_series from max to min. For boxplots,
-    letter_ordering_series with median values is a good choice.
-    
-    monte_carlo_cycles (default = 5): Function will always return correct letter representation however it may be suboptimal. 
-    Within each monte carlo cycle, a random letter is deleted until the representation breaks. The result with the optimum
-    number layout of letters after n monte_carlo_cycles is returned. 
-    
-    The optimum letter layout is set by primary_optimisation_parameter (default = "Number of different letters"):
-        'Number of different letter' optimises for fewest different letters
-        "Min letters per row" optimises for the fewest letters assigned per treatment
-        "Letter total" optimises for the fewest total letters of the treatments combined
-        
-    letter_separator (default = ''): Separator for each letter in string assigned to each treatment
-    
-    
-    Letter representation is determined by the method described by Piepho 2004: An Algorithm for a Letter-Based Representation
-    of All-Pairwise Comparisons
-    """
-    #'Insert' stage
-    #make df with all unique groups as index
-    letters_df = comparisons_df['group1'].append(comparisons_df['group2']).drop_duplicates().to_frame().set_index(0)
-    
-    letters_df[letters_df.shape[1]] = 1
-    for pos_result in comparisons_df.loc[comparisons_df['reject']==True].index:
-        group1 = comparisons_df.loc[pos_result, 'group1']
-        group2 = comparisons_df.loc[pos_result, 'group2']
-        for letter_col in letters_df:
-            group1_val = letters_df.loc[group1,letter_col]
-            group2_val = letters_df.loc[group2,letter_col]
-            if group1_val == 1 and group2_val == 1:
-                #duplicate column
-                new_col = letters_df.shape[1]
-                letters_df[new_col] = letters_df[letter_col]
-                #del val at group1 first col and at group2 new col
-                letters_df.loc[group1,letter_col] = 0
-                letters_df.loc[group2,new_col] = 0
-    #'Absorb' stage          
-    for col in letters_df:
-       other_cols_list = list(letters_df)
-       other_cols_list.remove(col)
-       col_total = letters_df[col].sum()
-       for other_col in other_cols_list:
-           matched_total = 0
-           for row in letters_df.index:
-               if letters_df.loc[row, col] == 1 and letters_df.loc[row, other_col]: matched_total +=1
-           if col_total == matched_total:
-               letters_df.drop(col, axis = 1, inplace = True)  
-               break
-        
-    def check_letters_against_tests(test_df, letters_df):
-        if letters_df.sum(axis = 1).min() == 0: return False
-        for result_row in test_df.index:
-            group1 = test_df.loc[result_row, 'group1']
-            group2 = test_df.loc[result_row, 'group2']
-            reject = bool(test_df.loc[result_row, 'reject'])
-            count_of_true_trues = 0
-            count_of_true_falses = 0
-            for letter_col in letters_df:
-                group1_val = letters_df.loc[group1,letter_col]
-                group2_val = letters_df.loc[group2,letter_col]
-                if reject:
-                    if group1_val != group2_val: count_of_true_trues += 1
-                    if group1_val == 1 and group2_val == 1: 
-                        return False
-                if reject == False:
-                    if group1_val == 1 and group2_val == 1: count_of_true_falses += 1
-            if reject and count_of_true_trues == 0: 
-                return False
-            if reject == False and count_of_true_falses == 0: 
-                return False
-        return True
-
-    #'Sweep stage' with monte carlo optimisation
-    for i in range(monte_carlo_cycles):
-        num_of_letters = letters_df.sum().sum()
-        num_list = list(np.arange(start = 1, stop = 1+ num_of_letters))
-        letters_df_monte_order = letters_df.copy()
-        for row in letters_df_monte_order.index:
-            for col in letters_df_monte_order:
-                if letters_df_monte_order.loc[row,col] == 0: continue
-                random_num = random.sample(num_list, 1)[0]
-                letters_df_monte_order.loc[row,col] = random_num
-                num_list.remove(random_num)
-        
-        current_letters_df = letters_df.copy()
-        for pos in range(num_of_letters + 1):     
-            mask = letters_df_monte_order.isin([pos])
-            zero_df = letters_df.copy().loc[:] = 0
-            letters_df_copy = current_letters_df.copy()
-            letters_df_copy.mask(mask, other = zero_df, inplace = True)
-            if check_letters_against_tests(comparisons_df,letters_df_copy):
-                current_letters_df = letters_df_copy
-        
-        for col in letters_df:
-            if current_letters_df[col].sum() == 0: current_letters_df.drop(col, axis = 1, inplace = True)
-            
-        # determine fitness parameters for optimisation
-        current_fitness_parameter_vals = {"Min letters per row":current_letters_df.sum(axis = 1).max(),
-                                          "Number of different letters": current_letters_df.shape[1],
-                                          "Letter total": current_letters_df.sum().sum()}
-        if i == 0: 
-            best_fitness_parameter_vals = current_fitness_parameter_vals
-            best_letters_df = current_letters_df
-            continue
-        
-        if current_fitness_parameter_vals[primary_optimisation_parameter] > best_fitness_parameter_vals[primary_optimisation_parameter]:
-            continue
-        if current_fitness_parameter_vals[primary_optimisation_parameter] < best_fitness_parameter_vals[primary_optimisation_parameter]:
-            best_letters_df = current_letters_df.copy()
-            best_fitness_parameter_vals = current_fitness_parameter_vals
-            
-        if sum(current_fitness_parameter_vals.values()) < sum(best_fitness_parameter_vals.values()):
-            best_letters_df = current_letters_df.copy()
-            best_fitness_parameter_vals = current_fitness_parameter_vals
-    
-    #order cols
-    if isinstance(letter_ordering_series, pd.Series):
-        scoring_df = pd.DataFrame(index = best_letters_df.index)
-        for row in best_letters_df.index:
-            for col in best_letters_df:
-                scoring_df.loc[row, col] = best_letters_df.loc[row, col] * letter_ordering_series[row]
-        scoring_df = scoring_df.replace(0, np.NaN)
-        scoring_means = scoring_df.mean(axis = 0).sort_values(ascending = False)
-        best_letters_df = best_letters_df[scoring_means.index]
-    # letter the cols     
-    for col_name, col_num in zip(best_letters_df, range(len(best_letters_df.columns))):
-        letter = string.ascii_lowercase[col_num]
-        best_letters_df.loc[best_letters_df[col_name] == 1, col_name] = letter
-    # make df with strings ready for presentation
-    best_string_df = pd.DataFrame(index = best_letters_df.index)
-    best_string_df.loc[:,'string'] = ""
-    for row in best_letters_df.index:
-        for col in best_letters_df:
-            if best_letters_df.loc[row, col] != 0:
-                letter_string = best_string_df.loc[row, 'string']
-                letter = best_letters_df.loc[row, col]
-                if letter_string == "": best_string_df.loc[row, 'string'] = letter
-                else: best_string_df.loc[row, 'string'] = letter_separator.join((letter_string, letter))
-                
-    return best_string_df
-
-def stack_correlation_table(df):
-    """
-    Converts a dataframe correlation table to a stacked comparisons table
-    """
-    df = df.stack().to_frame()
-    for row in df.index:
-        if row[0] == row[1]: 
-            df = df.drop(row)
-            continue
-        sorted_row = list(row)
-        sorted_row.sort()
-        df.loc[row,'A'], df.loc[row,'B'] = sorted_row[0], sorted_row[1]
-    df = df.set_index(['A', 'B'], drop = True)
-    df = df.loc[~df.index.duplicated(keep='first')]
-    return df
-
-def scikit_results_munger(results, alpha):
-    results = stack_correlation_table(results)
-    results.rename({0:'p'}, axis = 1, inplace = True)
-    results.loc[results['p'] <= alpha, 'reject'] = True
-    results.loc[results['p'] > alpha, 'reject'] = False
-    for row in results.index:
-        results.loc[row, 'group1'] = row[0]
-        results.loc[row, 'group2'] = row[1]
-    return results
-
-def post_hoc_df(df, Y_col, X_col, posthoc = "tukey", alpha = 0.05):
-    """
-    Returns a df with pairwise comparisons with reject column calculated according to alpha
-    
-    TODO: Add more posthoc tests to this function
-    """
-    if posthoc == "Statsmodels_tukey":
-        comp = multi.MultiComparison(df[Y_col], df['comb'])
-        results = comp.tukeyhsd(alpha=alpha)
-        results = pd.DataFrame(data=results._results_table.data[1:], columns=results._results_table.data[0])
-    if posthoc == "dunn": results = scikit_results_munger(sp.posthoc_dunn(df, val_col= Y_col, group_col= X_col, p_adjust = 'holm'), alpha)
-    if posthoc == "tukey": results = scikit_results_munger(sp.posthoc_tukey(df, val_col= Y_col, group_col= X_col), alpha)
-    return results
-
-if __name__ == "__main__":
-    data_url = 'http://bit.ly/2cLzoxH'
-    df = pd.read_csv(data_url)
-    df.rename(columns = {'lifeExp': "Life expectancy (years)"}, inplace = True)                   
-    #set Y col                    
-    Y_col = 'Life expectancy (years)'
-    #Grouping parameters
-    X_col = 'continent'
-    hue_col = 'year'
-    X_order = ['Asia', 'Africa']
-    hue_order = [1952, 1957, 1962, 1967, 1987, 2007]
-    #Set p threshold for ANOVA and Post hoc tests
-    alpha = 0.05 
-    #reduce df
-    df = df[df[X_col].isin(X_order)]
-    df = df[df[hue_col].isin(hue_order)]
-    #Combine X and Hue to form a group column
-    df['comb'] = df[X_col].map(str) + "│" + df[hue_col].map(str) 
-    #generate df with pairwise comparisons
-    pairwise_comps_df = post_hoc_df(df, Y_col, 'comb', posthoc = 'tukey', alpha = alpha)
-    # make df with median values for each group to order letter allocation 
-    #median_needs same index as df
-    median_df= df.groupby([X_col, hue_col])[Y_col].median().to_frame()
-    for row in median_df.index:
-        median_df.loc[row, 'comb'] = str(row[0]) + "│" + str(row[1])
-    median_df.set_index('comb', drop = True, inplace = True)
-    df['comb'] = df[X_col].map(str) + "│" + df[hue_col].map(str)    
-    #Convert pairwise comparisons to letters representation    
-    letters_df = multi_comparisons_letter_df_generator(pairwise_comps_df, 
-                                                       letter_ordering_series = median_df)
-
-
-
-
-        
\ No newline at end of file
+# -*- coding: utf-8 -*-
+"""
+'Python pairwise comparison letter generator'
+
+Github: PhilPlantMan
+"""
+import os
+import time
+import pandas as pd
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import pairwisecomp_core as core
+# statsmodels, scikit-posthocs and scipy are imported by the post hoc functions the first time they are called, so 
+# the letter generator can be imported without them
+
+
+def comparison_indices(comparisons_df):
+    """
+    Returns (group_index, group1, group2, reject) for a df of pairwise comparisons: the groups in order of appearance
+    as a pd.Index, the integer positions of 'group1' and 'group2' in it and 'reject' as a boolean array
+    """
+    groups = pd.unique(np.concatenate((comparisons_df['group1'].to_numpy(), comparisons_df['group2'].to_numpy())))
+    group_index = pd.Index(groups, name = 0)
+    return (group_index, group_index.get_indexer(comparisons_df['group1']), 
+            group_index.get_indexer(comparisons_df['group2']), (comparisons_df['reject'] == True).to_numpy())
+
+def multi_comparisons_letter_df_generator(comparisons_df, letter_ordering_series = None, 
+                                          primary_optimisation_parameter = "Number of different letters", 
+                                          monte_carlo_cycles = 5, letter_separator = '', random_state = None, 
+                                          n_jobs = None, executor = None, time_budget = None, patience = None, 
+                                          return_report = False, engine = "sweep", max_search_nodes = 100000, cache = None, 
+                                          stats = None): 
+    """
+    Function takes a df listing pairwise comparisons with a cols labelled 'group1' and 'group2' for the two groups being compared 
+    and another column labelled 'reject' with boolean values corresponding to whether the null hypothesis should be rejected 
+    i.e. True: Both treatments are significantly different
+    
+    letter_ordering_series (default = None): In theory, which letters are assigned to each non-significance grouping is
+    arbitrary and therefor the order can be changed. Offering letter_ordering_series a series with the same index as the output
+    will make sure that the order that letters are assigned will follow letter_ordering_series from max to min. For boxplots,
+    letter_ordering_series with median values is a good choice.
+    
+    monte_carlo_cycles (default = 5): Function will always return correct letter representation however it may be suboptimal. 
+    Within each monte carlo cycle, a random letter is deleted until the representation breaks. The result with the optimum
+    number layout of letters after n monte_carlo_cycles is returned. 
+    
+    The optimum letter layout is set by primary_optimisation_parameter (default = "Number of different letters"):
+        'Number of different letter' optimises for fewest different letters
+        "Min letters per row" optimises for the fewest letters assigned per treatment
+        "Letter total" optimises for the fewest total letters of the treatments combined
+        
+    letter_separator (default = ''): Separator for each letter in string assigned to each treatment. Letters run a-z, then
+    A-Z, then repeat with a numeric suffix.
+    
+    random_state (default = None): Seed (int or sequence of ints) for the monte carlo cycles. Each cycle draws its
+    sweep order from its own numpy.random.Generator spawned from random_state, so results are reproducible. Without
+    random_state, n_jobs or executor the cycles draw from the global random module as before.
+    
+    n_jobs (default = None): Number of worker processes the monte carlo cycles are split across, -1 for every CPU. The letters
+    from the insert and absorb stages are sent to each worker once. For a given random_state the result does not depend on n_jobs.
+    
+    executor (default = None): A concurrent.futures executor to run the cycles on instead of starting a process pool, e.g. to
+    reuse one pool across calls.
+    
+    time_budget (default = None): Wall-clock seconds after which no further monte carlo cycles are started. The best letters
+    found so far are returned. With n_jobs > 1 the budget is checked after each round of one cycle per worker.
+    
+    patience (default = None): Stop once this many cycles in a row have not improved the best letters.
+    
+    With time_budget or patience, monte_carlo_cycles is an upper limit and may be None for no limit. At least one cycle
+    always runs.
+    
+    return_report (default = False): Also return a dict describing the optimisation: 'Cycles run', 'Best cycle', 'Best fitness',
+    'Fitness history' (fitness parameters of every cycle), 'Best fitness history' (best primary_optimisation_parameter after
+    every cycle), 'Stopped by' ('monte_carlo_cycles', 'time_budget' or 'patience') and 'Seconds'.
+    
+    engine (default = "sweep"): "sweep" runs the monte carlo sweep described above. "clique" instead treats the letters as a
+    cover of the graph of non-significant pairs by cliques: maximal cliques are enumerated (Bron-Kerbosch with pivoting on
+    bitsets) and the fewest that cover every non-significant pair and every group are chosen, greedily and then by a branch
+    and bound search limited to max_search_nodes nodes. It minimises 'Number of different letters' whatever
+    primary_optimisation_parameter is and ignores the monte carlo arguments. Its report (return_report = True) gives the
+    'Lower bound' on the number of letters and the 'Optimality gap'; 'Optimal' is True when the search finished. It is
+    well suited to designs of up to ~40 groups; the number of maximal cliques can grow quickly beyond that.
+    
+    cache (default = None): A pairwisecomp_core.LetteringCache. The letters (before letter_ordering_series is applied) are
+    stored under a hash of the groups, the reject pattern in comparisons_df and the arguments that change the result, and
+    reused when the same pattern comes up again, also under different group labels, without running the stages again.
+    The report then has 'Cached': True. Note that without a random_state a hit returns the letters of an earlier draw.
+    
+    stats (default = None): A dict to fill with instrumentation of this call for profiling or metrics export: 'Groups', 
+    'Comparisons', 'Significant comparisons', 'Engine', 'Setup seconds', the stage timings and counters of 
+    pairwisecomp_core.letter_matrix (column duplications of the insert, letter columns before and after absorb, 
+    validity checks, accepted and rejected deletions, fitness of every cycle) or 'Clique cover seconds', 'Maximal cliques' and 'Search nodes' for the 
+    clique engine, 'Cached' with a cache, 'Ordering seconds' (letter order and strings) and 'Total seconds'. Leaving 
+    it out costs nothing but a few clock reads.
+    
+    The stages run on a boolean group x letter matrix in pairwisecomp_core and are only converted to a df at the end.
+    
+    Letter representation is determined by the method described by Piepho 2004: An Algorithm for a Letter-Based Representation
+    of All-Pairwise Comparisons
+    """
+    start_time = time.perf_counter()
+    group_index, group1, group2, reject = comparison_indices(comparisons_df)
+    lap = core.record_seconds(stats, "Setup seconds", start_time)
+    if stats is not None: 
+        stats.update({"Groups": len(group_index), "Comparisons": len(reject), "Significant comparisons": int(reject.sum()), 
+                      "Engine": engine})
+    if cache is not None:
+        key = core.lettering_key(len(group_index), group1, group2, reject, engine = engine, 
+                                 primary_optimisation_parameter = primary_optimisation_parameter, 
+                                 monte_carlo_cycles = monte_carlo_cycles, random_state = random_state, 
+                                 time_budget = time_budget, patience = patience, max_search_nodes = max_search_nodes)
+        cached = cache.get(key)
+    if cache is not None and cached is not None:
+        best_letters, report = cached
+    elif engine == "clique":
+        best_letters, report = core.clique_cover(len(group_index), group1, group2, reject, max_nodes = max_search_nodes)
+        if stats is not None: 
+            core.record_seconds(stats, "Clique cover seconds", lap)
+            stats.update({"Maximal cliques": report["Maximal cliques"], "Search nodes": report["Search nodes"]})
+    elif engine == "sweep":
+        best_letters, report = core.letter_matrix(len(group_index), group1, group2, reject, 
+                                                  primary_optimisation_parameter = primary_optimisation_parameter, 
+                                                  monte_carlo_cycles = monte_carlo_cycles, random_state = random_state, 
+                                                  n_jobs = n_jobs, executor = executor, time_budget = time_budget, 
+                                                  patience = patience, return_report = True, stats = stats)
+    else: raise ValueError("engine must be 'sweep' or 'clique'")
+    if cache is not None:
+        if cached is None: cache.put(key, best_letters, report)
+        report["Cached"] = cached is not None
+        if stats is not None: stats["Cached"] = cached is not None
+    lap = time.perf_counter()
+    #order cols
+    if isinstance(letter_ordering_series, pd.Series):
+        best_letters = best_letters[:, core.letter_column_order(best_letters, letter_ordering_series.loc[group_index])]
+    # make df with strings ready for presentation
+    best_string_df = pd.DataFrame(index = group_index)
+    best_string_df['string'] = core.letter_strings(best_letters, letter_separator)
+    if stats is not None:
+        stats["Letters"] = best_letters.shape[1]
+        core.record_seconds(stats, "Ordering seconds", lap)
+        core.record_seconds(stats, "Total seconds", start_time)
+    if return_report: return best_string_df, report
+    return best_string_df
+
+def _upper_triangle_pairs(df):
+    """
+    Returns the sorted labels (A, B) and value of every pair of different labels in a symmetric table with the 
+    same labels on both axes. Values come from the upper triangle, or the lower triangle where the upper is missing. 
+    Pairs missing in both are left out.
+    """
+    labels = df.index.to_numpy()
+    values = df.reindex(columns = df.index).to_numpy()
+    rows, cols = np.triu_indices(len(labels), k = 1)
+    pair_values = np.where(pd.isna(values[rows, cols]), values[cols, rows], values[rows, cols])
+    keep = ~pd.isna(pair_values)
+    first, second = labels[rows[keep]], labels[cols[keep]]
+    swap = second < first
+    return np.where(swap, second, first), np.where(swap, first, second), pair_values[keep]
+
+def stack_correlation_table(df):
+    """
+    Converts a dataframe correlation table to a stacked comparisons table
+    """
+    A, B, values = _upper_triangle_pairs(df)
+    return pd.DataFrame({0: values}, index = pd.MultiIndex.from_arrays([A, B], names = ['A', 'B']))
+
+def scikit_results_munger(results, alpha):
+    A, B, p = _upper_triangle_pairs(results)
+    return pd.DataFrame({'p': p, 'reject': p <= alpha, 'group1': A, 'group2': B}, 
+                        index = pd.MultiIndex.from_arrays([A, B], names = ['A', 'B']))
+
+def post_hoc_df(df, Y_col, X_col, posthoc = "tukey", alpha = 0.05):
+    """
+    Returns a df with pairwise comparisons with reject column calculated according to alpha
+    
+    TODO: Add more posthoc tests to this function
+    """
+    import statsmodels.stats.multicomp as multi
+    import scikit_posthocs as sp
+    if posthoc == "Statsmodels_tukey":
+        comp = multi.MultiComparison(df[Y_col], df[X_col])
+        results = comp.tukeyhsd(alpha=alpha)
+        results = pd.DataFrame(data=results._results_table.data[1:], columns=results._results_table.data[0])
+    if posthoc == "dunn": results = scikit_results_munger(sp.posthoc_dunn(df, val_col= Y_col, group_col= X_col, p_adjust = 'holm'), alpha)
+    if posthoc == "tukey": results = scikit_results_munger(sp.posthoc_tukey(df, val_col= Y_col, group_col= X_col), alpha)
+    return results
+
+def read_chunks(source, columns, chunksize = 1000000):
+    """
+    Yields df chunks of at most chunksize rows holding only columns from source: a path to a Parquet file 
+    (.parquet/.pq, read with pyarrow), a path to a CSV file (anything else, read with pd.read_csv), or an iterable 
+    of dfs that is passed through (e.g. a filtering generator around another reader).
+    """
+    if not isinstance(source, (str, os.PathLike)):
+        for chunk in source: yield chunk[columns]
+        return
+    if str(source).lower().endswith(('.parquet', '.pq')):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(source).iter_batches(batch_size = chunksize, columns = columns):
+            yield batch.to_pandas()
+        return
+    for chunk in pd.read_csv(source, usecols = columns, chunksize = chunksize): yield chunk[columns]
+
+def _append_groups(groups, new_groups):
+    new_groups = new_groups[~new_groups.isin(groups)]
+    return groups.append(new_groups) if len(new_groups) else groups
+
+def tukey_summary(chunks, Y_col, X_col):
+    """
+    Returns a df indexed by group (in order of first appearance) with the columns 'count', 'mean' and 'M2' (sum of 
+    squared deviations from the mean) of Y_col, merged chunk by chunk with the pairwise update of Chan et al.
+    """
+    groups, count, mean, M2 = pd.Index([]), np.zeros(0), np.zeros(0), np.zeros(0)
+    for chunk in chunks:
+        grouped = chunk.groupby(X_col, sort = False)[Y_col]
+        chunk_count = grouped.count()
+        groups = _append_groups(groups, chunk_count.index)
+        grow = len(groups) - len(count)
+        count, mean, M2 = (np.concatenate([a, np.zeros(grow)]) for a in (count, mean, M2))
+        at = groups.get_indexer(chunk_count.index)
+        n_b = chunk_count.to_numpy(dtype = float)
+        mean_b = grouped.mean().to_numpy()
+        M2_b = (grouped.var(ddof = 0) * chunk_count).to_numpy()
+        n_a, mean_a = count[at], mean[at]
+        n = n_a + n_b
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            delta = np.nan_to_num(mean_b - mean_a)
+            mean[at] = np.where(n > 0, mean_a + delta * n_b / n, 0)
+            M2[at] = M2[at] + np.nan_to_num(M2_b) + np.where(n > 0, delta**2 * n_a * n_b / n, 0)
+        count[at] = n
+    return pd.DataFrame({'count': count, 'mean': mean, 'M2': M2}, index = groups)
+
+def tukey_from_summary(summary):
+    """
+    Returns the square df of Tukey HSD p values (as sp.posthoc_tukey) from the per group count, mean and M2 of 
+    tukey_summary. Groups without observations are left out, as post_hoc_df leaves them out.
+    """
+    from scipy import stats
+    summary = summary[summary['count'] > 0]
+    counts, means = summary['count'].to_numpy(), summary['mean'].to_numpy()
+    k, n = len(summary), counts.sum()
+    pooled_var = summary['M2'].sum() / (n - k)
+    A, B = np.triu_indices(k, 1)
+    q = (means[A] - means[B]) / np.sqrt(pooled_var * 0.5 * (1.0 / counts[A] + 1.0 / counts[B]))
+    p = np.ones((k, k))
+    p[A, B] = p[B, A] = stats.studentized_range.sf(np.abs(q), k, n - k)
+    return pd.DataFrame(p, index = summary.index, columns = summary.index)
+
+def dunn_summary(chunks, Y_col, X_col):
+    """
+    Returns a series with the number of observations of each (group, value) pair of X_col and Y_col, leaving out rows 
+    with either missing. Ranks only depend on these counts, so this is all Dunn's test needs; its size scales with 
+    the number of distinct values per group (round continuous measurements to their precision to bound it).
+    """
+    parts, consolidated = [], 0
+    for chunk in chunks:
+        parts.append(chunk.dropna().groupby([X_col, Y_col], sort = False).size())
+        if sum(map(len, parts)) > 2 * consolidated + chunk.shape[0]:
+            parts = [pd.concat(parts).groupby(level = [0, 1]).sum()]
+            consolidated = len(parts[0])
+    if not parts: return pd.Series([], dtype = np.int64, index = pd.MultiIndex.from_arrays([[], []], names = [X_col, Y_col]))
+    return pd.concat(parts).groupby(level = [0, 1]).sum()
+
+def dunn_from_summary(summary, p_adjust = 'holm'):
+    """
+    Returns the square df of Dunn's test p values (as sp.posthoc_dunn, groups sorted) from the (group, value) counts of 
+    dunn_summary
+    """
+    from scipy import stats
+    from statsmodels.stats.multitest import multipletests
+    value_counts = summary.groupby(level = 1).sum().sort_index()
+    below = value_counts.cumsum() - value_counts
+    value_ranks = below + (value_counts + 1) / 2.0
+    rank_sums = (summary * value_ranks.reindex(summary.index.get_level_values(1)).to_numpy()).groupby(level = 0).sum()
+    counts = summary.groupby(level = 0).sum()
+    groups = counts.index
+    counts, rank_means = counts.to_numpy(dtype = float), (rank_sums / counts).to_numpy()
+    k, n = len(groups), counts.sum()
+    ties = value_counts.to_numpy(dtype = float)
+    ties = np.sum(ties**3 - ties) / (12.0 * (n - 1))
+    A, B = np.triu_indices(k, 1)
+    z = np.abs(rank_means[A] - rank_means[B]) / np.sqrt((n * (n + 1.0) / 12.0 - ties) * (1.0 / counts[A] + 1.0 / counts[B]))
+    p = 2.0 * stats.norm.sf(z)
+    if p_adjust: p = multipletests(p, method = p_adjust)[1]
+    matrix = np.ones((k, k))
+    matrix[A, B] = matrix[B, A] = p
+    return pd.DataFrame(matrix, index = groups, columns = groups)
+
+def post_hoc_df_streamed(source, Y_col, X_col, posthoc = "tukey", alpha = 0.05, chunksize = 1000000):
+    """
+    Returns the same df of pairwise comparisons as post_hoc_df without holding the raw data in memory. source is 
+    read in chunks with read_chunks (a CSV or Parquet path, or an iterable of dfs) and only per group sufficient 
+    statistics are kept: count, mean and M2 for "tukey", (group, value) counts for "dunn" (Holm adjusted). Memory 
+    therefore scales with the number of groups (and, for "dunn", distinct values) rather than the number of rows.
+    """
+    chunks = read_chunks(source, [Y_col, X_col], chunksize = chunksize)
+    if posthoc == "tukey": results = tukey_from_summary(tukey_summary(chunks, Y_col, X_col))
+    elif posthoc == "dunn": results = dunn_from_summary(dunn_summary(chunks, Y_col, X_col))
+    else: raise ValueError("posthoc must be 'tukey' or 'dunn' when streaming")
+    return scikit_results_munger(results, alpha)
+
+def factorise_groups(df, group_cols):
+    """
+    Returns (codes, keys): an integer group code for each row of df and the group key of each code, as an Index 
+    (one grouping column) or MultiIndex (several). Codes follow the sorted keys; rows with a missing key get -1. Only 
+    observed keys get a code, so unused categories of categorical columns are left out.
+    """
+    grouped = df.groupby(group_cols, sort = True, observed = True, dropna = True)
+    codes = grouped.ngroup().fillna(-1).to_numpy(dtype = np.intp)
+    return codes, grouped.size().index
+
+def posthoc_letters(df, Y_col, group_cols, posthoc = "tukey", alpha = 0.05, letter_ordering_series = None, **letter_kwargs):
+    """
+    Returns a df of letters (column 'string') for the groups formed by group_cols (e.g. [X_col, hue_col]), indexed by 
+    the group keys (a MultiIndex for several columns). 
+    
+    The groups are factorised to integer codes with factorise_groups, so the post hoc test, the medians that order the 
+    letters and multi_comparisons_letter_df_generator (which receives letter_kwargs) all work on codes and the keys are 
+    only attached at the end, whatever their types. Rows with a missing group key are left out.
+    
+    letter_ordering_series (default = None): Values indexed by the group keys that order the letters (as in 
+    multi_comparisons_letter_df_generator), e.g. medians already at hand. By default the group medians are used.
+    """
+    codes, keys = factorise_groups(df, group_cols)
+    rows = codes >= 0
+    values, codes = df[Y_col].to_numpy()[rows], codes[rows]
+    if letter_ordering_series is None: ordering = pd.Series(values).groupby(codes).median()
+    else: ordering = pd.Series(letter_ordering_series.reindex(keys).to_numpy(), index = np.arange(len(keys)))
+    strings = _batch_letters_job(values, codes, ordering, posthoc, alpha, letter_kwargs)
+    return pd.DataFrame({'string': strings.to_numpy()}, index = keys[strings.index])
+
+def _batch_letters_job(values, codes, ordering, posthoc, alpha, letter_kwargs):
+    """
+    Post hoc test and letters for one response of one stratum, on integer group codes. Top level so it can run in 
+    worker processes. With fewer than two groups holding a value there is nothing to compare: the test is skipped 
+    and the group (if any) gets the letter 'a'.
+    """
+    observed = np.unique(codes[pd.notna(values)])
+    if len(observed) < 2: return pd.Series('a', index = observed, name = 'string', dtype = object)
+    frame = pd.DataFrame({'Y': values, 'group': codes})
+    comparisons_df = post_hoc_df(frame, 'Y', 'group', posthoc = posthoc, alpha = alpha)
+    return multi_comparisons_letter_df_generator(comparisons_df, letter_ordering_series = ordering, **letter_kwargs)['string']
+
+def posthoc_letters_batch(df, Y_cols, group_cols, strata_cols = None, posthoc = "tukey", alpha = 0.05, 
+                          n_jobs = None, executor = None, **letter_kwargs):
+    """
+    Returns the letters for every response in Y_cols (and every stratum of strata_cols) as one long-format df with the 
+    columns: strata_cols, 'Y col', group_cols, 'median' and 'string'.
+    
+    Groups (the combinations of group_cols, e.g. [X_col, hue_col]) and strata are factorised once and the medians used 
+    to order the letters are computed for all responses in one groupby. Each response/stratum is then tested with 
+    post_hoc_df and lettered with multi_comparisons_letter_df_generator, which receives letter_kwargs (other than n_jobs 
+    and executor). Rows with a missing group or stratum key are left out. A response/stratum with a single group is 
+    not tested and that group gets the letter 'a'; one without values adds no rows.
+    
+    n_jobs (default = None): Number of worker processes the responses/strata are spread across, -1 for every CPU. 
+    executor (default = None): A concurrent.futures executor to use instead of starting a process pool.
+    """
+    if isinstance(group_cols, str): group_cols = [group_cols]
+    if isinstance(strata_cols, str): strata_cols = [strata_cols]
+    codes, keys = factorise_groups(df, group_cols)
+    if strata_cols: strata_codes, strata_keys = factorise_groups(df, strata_cols)
+    else: strata_codes, strata_keys = np.zeros(len(df), dtype = np.intp), [None]
+    medians = df[Y_cols].groupby([strata_codes, codes]).median()
+    jobs = []
+    for stratum in range(len(strata_keys)):
+        rows = np.flatnonzero((strata_codes == stratum) & (codes >= 0))
+        for Y_col in Y_cols:
+            ordering = medians[Y_col].loc[stratum]
+            jobs.append((stratum, Y_col, (df[Y_col].to_numpy()[rows], codes[rows], ordering, posthoc, alpha, letter_kwargs)))
+    if executor is None and core.worker_count(n_jobs) > 1:
+        with ProcessPoolExecutor(max_workers = core.worker_count(n_jobs)) as pool:
+            letters = [future.result() for future in [pool.submit(_batch_letters_job, *job) for _, _, job in jobs]]
+    elif executor is None: letters = [_batch_letters_job(*job) for _, _, job in jobs]
+    else: letters = [future.result() for future in [executor.submit(_batch_letters_job, *job) for _, _, job in jobs]]
+    results = []
+    for (stratum, Y_col, job), strings in zip(jobs, letters):
+        strings = strings.sort_index()
+        result = keys[strings.index].to_frame(index = False)
+        result.insert(0, 'Y col', Y_col)
+        if strata_cols:
+            stratum_key = strata_keys[stratum] if len(strata_cols) > 1 else (strata_keys[stratum],)
+            for position, (col, value) in enumerate(zip(strata_cols, stratum_key)): result.insert(position, col, value)
+        result['median'] = medians[Y_col].loc[stratum].loc[strings.index].to_numpy()
+        result['string'] = strings.to_numpy()
+        results.append(result)
+    return pd.concat(results, ignore_index = True)
+
+if __name__ == "__main__":
+    data_url = 'http://bit.ly/2cLzoxH'
+    df = pd.read_csv(data_url)
+    df.rename(columns = {'lifeExp': "Life expectancy (years)"}, inplace = True)                   
+    #set Y col                    
+    Y_col = 'Life expectancy (years)'
+    #Grouping parameters
+    X_col = 'continent'
+    hue_col = 'year'
+    X_order = ['Asia', 'Africa']
+    hue_order = [1952, 1957, 1962, 1967, 1987, 2007]
+    #Set p threshold for ANOVA and Post hoc tests
+    alpha = 0.05 
+    #reduce df
+    df = df[df[X_col].isin(X_order)]
+    df = df[df[hue_col].isin(hue_order)]
+    #Factorise X and Hue to one integer group code per row (keys[code] gives the (X, Hue) pair)
+    codes, keys = factorise_groups(df, [X_col, hue_col])
+    df['group'] = codes
+    #generate df with pairwise comparisons
+    pairwise_comps_df = post_hoc_df(df, Y_col, 'group', posthoc = 'tukey', alpha = alpha)
+    # make series with median values for each group to order letter allocation 
+    #median_needs same index as the output (the group codes)
+    median_series = df.groupby('group')[Y_col].median()
+    #Convert pairwise comparisons to letters representation    
+    letters_df = multi_comparisons_letter_df_generator(pairwise_comps_df, 
+                                                       letter_ordering_series = median_series)
+    #Swap the group codes for their (X, Hue) keys
+    letters_df.index = keys[letters_df.index]